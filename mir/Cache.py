@@ -0,0 +1,154 @@
+"""
+Content addressed on-disk cache for the spectral features of a recording.
+
+Features are stored as .npy files named after a hash of the audio content and of every parameter used to compute them,
+they are loaded memory mapped so a re-run on the same audio does not recompute nor copy them.
+The decoded and resampled signal of an audio file is stored the same way under the hash of the file, see file_digest,
+so the runs and the processes reading the same file share one decoded copy through the page cache.
+
+The cache directory and its maximal size (in MB) are configured with the MIR_CACHE_DIR and MIR_CACHE_SIZE environment
+variables, MIR_CACHE_SIZE=0 disables the cache.
+"""
+import hashlib
+import json
+import os
+import librosa
+import numpy as np
+
+CACHE_DIR = os.environ.get("MIR_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mir"))
+CACHE_SIZE = int(float(os.environ.get("MIR_CACHE_SIZE", 2048)) * 1024**2)
+
+
+def file_digest(path: str, chunk_size: int = 2**20) -> str:
+    """
+    Hash of the content of the file at path, read by chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    Least recently used cache of numpy arrays on disk.
+
+    The key of a feature holds the version of the code computing it, see versions.
+    ----------
+    Methods:
+        key(name, digest, params) -> return : str
+        load(key) -> return : np.memmap | None
+        save(key, array)
+        get(name, digest, params, compute) -> return : np.ndarray
+        clear()
+    """
+    # bump the version of a feature when the way it is computed changes, the arrays cached by the previous code are
+    # computed again. The features missing here are at version 1
+    versions = {"decoded_audio": 1, "decimated_signal": 1, "tuning": 1, "high_resolution_cqt": 2, "chroma": 2,
+                "onset_strength": 1, "pyin": 1, "yin": 1, "cqt": 1, "logstft": 1}
+
+    def __init__(self, directory: str = CACHE_DIR, max_size: int = CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None and self.max_size > 0
+
+    def key(self, name: str, digest: str, params: dict) -> str:
+        """
+        Hash of the feature name and version, of the audio digest and of every parameter affecting the feature.
+        """
+        description = json.dumps({"feature": name, "version": self.versions.get(name, 1), "audio": digest,
+                                  "librosa": librosa.__version__, **params}, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npy")
+
+    def load(self, key: str):
+        """
+        Memory map the array stored under key, returns None if it is not in the cache.
+        """
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode="r")
+            # the modification time keeps track of the last use for the eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return array
+
+    def save(self, key: str, array: np.ndarray):
+        """
+        Store array under key and evict the least recently used arrays if the cache is full.
+        """
+        if array.nbytes > self.max_size:
+            return
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            # the rename is atomic, concurrent runs never see a partially written array
+            os.replace(tmp_path, path)
+        except OSError:
+            # the cache is an optimisation, a read-only or full disk must not stop the transcription
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used arrays until the cache fits in max_size.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def get(self, name: str, digest: str, params: dict, compute):
+        """
+        Returns the feature from the cache, compute() is only called if it is not in the cache yet.
+
+        Parameters
+        ----------
+        name : name of the feature, ex: 'cqt'
+        digest : hash of the audio content, see AudioSignal.digest
+        params : every parameter affecting the result of compute
+        compute : callable returning the feature as a np.ndarray
+        """
+        if not self.enabled:
+            return compute()
+        key = self.key(name, digest, params)
+        array = self.load(key)
+        if array is None:
+            array = compute()
+            self.save(key, array)
+        return array
+
+    def clear(self):
+        """
+        Remove every array of the cache.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                os.remove(os.path.join(self.directory, name))
+
+
+feature_cache = FeatureCache()
@@ -8,6 +8,7 @@ TODO:
 
 import librosa
 from mir.MusicRetrieval import AudioSignal
+from mir.MIR_lib import viterbi_batch
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -27,7 +28,7 @@ class ChordIdentifier(AudioSignal):
     def __init__(self, AUDIO: AudioSignal):
         super(ChordIdentifier, self)
         self.audio = AUDIO
-        self.chroma = librosa.feature.chroma_cqt(y=AUDIO.y, sr=AUDIO.sampling_rate, hop_length=AUDIO.hop_length)
+        self.chroma = np.array(AUDIO.features.chroma("y"), dtype=AUDIO.float_dtype)
 
     @property
     def chord_transition_matrix(self) -> np.ndarray:
@@ -47,7 +48,7 @@ class ChordIdentifier(AudioSignal):
         p_stay_silent = 0.1
         N = self.chord_labels.shape[0]
         """compute a uniform transition matrix between chords"""
-        A = np.ones((N, N)) * (1 - p) / (N - 1)
+        A = np.ones((N, N), dtype=self.audio.float_dtype) * (1 - p) / (N - 1)
         np.fill_diagonal(A, p)
         if p_stay_silent != p:
             A[0, 0] = p_stay_silent
@@ -120,7 +121,7 @@ class ChordIdentifier(AudioSignal):
         argmax_mask: np.array((24,Any)) most probable chord at each fram is True else False,
         chords_observation: np.array((24,Any)) contains the probability of each chord at each frame
         """
-        chords_observation = self.chord_template.T @ self.chroma  # dot product for every element in the chroma with the chord template
+        chords_observation = self.chord_template.T.astype(self.audio.float_dtype) @ self.chroma  # dot product for every element in the chroma with the chord template
 
         # normalise the columns to get a usable probability distribution
         chords_observation /= np.sum(chords_observation, axis=0, keepdims=True)
@@ -136,11 +137,30 @@ class ChordIdentifier(AudioSignal):
         transmat = self.chord_transition_matrix
         _, obs_mat = self.observation_matrix
         # uniform initial distribution
-        p_init = np.ones(obs_mat.shape[0]) / obs_mat.shape[0]
+        p_init = np.ones(obs_mat.shape[0], dtype=obs_mat.dtype) / obs_mat.shape[0]
         sequence = librosa.sequence.viterbi(obs_mat, transmat, p_init=p_init)
         # named_sequence = self.chord_labels[sequence]
         return sequence
 
+    @staticmethod
+    def solve_batch(identifiers: list["ChordIdentifier"]) -> list[np.ndarray]:
+        """
+        Returns the most probable chord at each frame of every identifier, as solve,
+        the recordings of the same precision are decoded together, see viterbi_batch.
+        """
+        groups = {}
+        for index, identifier in enumerate(identifiers):
+            groups.setdefault(identifier.audio.float_dtype, []).append(index)
+        sequences = [None] * len(identifiers)
+        for indices in groups.values():
+            first = identifiers[indices[0]]
+            n_chords = first.chord_labels.shape[0]
+            p_init = np.ones(n_chords, dtype=first.audio.float_dtype) / n_chords
+            probs = [identifiers[index].observation_matrix[1] for index in indices]
+            for index, sequence in zip(indices, viterbi_batch(probs, first.chord_transition_matrix, p_init)):
+                sequences[index] = sequence
+        return sequences
+
     def show(self, this="result"):
         """
         Display the result, observation, observation mask or transition matrix
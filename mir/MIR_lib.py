@@ -1,6 +1,7 @@
 """Enum for the different Situations that can happen when transitioning from one note to another"""
 
 from enum import Enum
+from functools import lru_cache
 from os import truncate
 import numpy as np
 from numpy.lib.twodim_base import diag
@@ -59,6 +60,294 @@ def classify_case(i:int,j:int):
             return Situation.SUSTAIN_to_SUSTAIN
     return Situation.IMPOSSIBLE
 
+def classify_cases(n_states: int) -> np.ndarray:
+    """
+    Vectorised classify_case: the Situation value of every transition (i, j) between the n_states states.
+    """
+    i, j = np.indices((n_states, n_states))
+    silence_i, onset_i, sustain_i = i == 0, i % 2 != 0, (i % 2 == 0) & (i != 0)
+    silence_j, onset_j = j == 0, j % 2 != 0
+    situations = np.full((n_states, n_states), Situation.IMPOSSIBLE.value)
+    situations[silence_i & silence_j] = Situation.SILENCE_to_SILENCE.value
+    situations[silence_i & onset_j] = Situation.SILENCE_to_ONSET.value
+    situations[onset_i & silence_j] = Situation.ONSET_to_SILENCE.value
+    situations[onset_i & (j == i + 1)] = Situation.ONSET_to_SUSTAIN.value
+    situations[sustain_i & silence_j] = Situation.SUSTAIN_to_SILENCE.value
+    situations[sustain_i & onset_j] = Situation.SUSTAIN_to_ONSET.value
+    situations[sustain_i & (j == i)] = Situation.SUSTAIN_to_SUSTAIN.value
+    return situations
+
+
+class NoteHMM:
+    """
+    Hidden Markov model of the note states: silence, then the onset and the sustain of every note.
+    Build it with note_hmm, the models are shared and their arrays are read only.
+    ----------
+    Methods:
+        viterbi(prob) -> return : [n_frames] np.array of the states
+        viterbi_batch(probs) -> return : list of [n_frames] np.array of the states of every recording
+        forward(log_prob, value) -> return : value, ptr
+        backtrack(ptr, state) -> return : [n_frames] np.array of the states
+    ----------
+    attributes:
+        n_states -> return : int, 2 * n_notes + 1
+        probabilities -> return : [len(Situation)] np.array, probability of each Situation
+        transition_matrix -> return : [n_states, n_states] np.array
+        p_init -> return : [n_states] np.array, uniform over the silence and onset states
+    """
+    def __init__(self, n_notes: int, prob_stay_note: float = 0.9, prob_stay_silence: float = 0.5):
+        """
+        Parameters
+        ----------
+        n_notes : int
+            Number of notes of the model.
+        prob_stay_note : float
+            The probability of staying in the same note state.
+        prob_stay_silence : float
+            The probability of staying in the silence state.
+        """
+        self.n_notes = n_notes
+        self.prob_stay_note = prob_stay_note
+        self.prob_stay_silence = prob_stay_silence
+        # state 1, 3, 5 ... are onsets
+        # state 2, 4, 6 ... are sustains
+        self.n_states = 2 * n_notes + 1  # +1 for silence state
+
+        # probability of each Situation, the transitions from onset to silence are impossible:
+        # the window is assumed to be too small to go from onset to onset or onset to silence
+        self.probabilities = np.zeros(len(Situation))
+        self.probabilities[Situation.SILENCE_to_SILENCE.value] = prob_stay_silence
+        self.probabilities[Situation.SILENCE_to_ONSET.value] = (1 - prob_stay_silence) / n_notes
+        self.probabilities[Situation.ONSET_to_SUSTAIN.value] = 1
+        self.probabilities[Situation.SUSTAIN_to_SUSTAIN.value] = prob_stay_note
+        self.probabilities[Situation.SUSTAIN_to_SILENCE.value] = (1 - prob_stay_note) / (n_notes + 1)
+        self.probabilities[Situation.SUSTAIN_to_ONSET.value] = (1 - prob_stay_note) / (n_notes + 1)
+        self.transition_matrix = self.probabilities[classify_cases(self.n_states)]
+
+        self.p_init = np.zeros(self.n_states)
+        self.p_init[0] = 1 / (n_notes + 1)
+        self.p_init[1::2] = 1 / (n_notes + 1)
+
+        self.probabilities.flags.writeable = False
+        self.transition_matrix.flags.writeable = False
+        self.p_init.flags.writeable = False
+
+    def viterbi(self, prob: np.ndarray) -> np.ndarray:
+        """
+        Most likely state sequence given the observation likelihoods prob [n_states, n_frames].
+
+        The decoding follows the structure of the model instead of the dense transition matrix,
+        so a frame costs O(n_states) instead of O(n_states^2), see forward.
+        The log probabilities and the ties are computed as in librosa.sequence.viterbi, so the state sequence is
+        the same as librosa.sequence.viterbi(prob, transition_matrix, p_init=p_init).
+        """
+        value, ptr = self.forward(np.log(prob.T + np.finfo(prob.dtype).tiny))
+        return self.backtrack(ptr, np.argmax(value))
+
+    def viterbi_batch(self, probs: list[np.ndarray]) -> list[np.ndarray]:
+        """
+        Most likely state sequence of every observation likelihoods [n_states, n_frames] of probs.
+
+        The recordings are decoded together: they are padded to the longest one (see pad_observations) and every step
+        of the recursion runs on all of them at once. The sequences are the ones of viterbi on every prob,
+        computed in the common dtype of probs.
+        """
+        if not probs:
+            return []
+        prob, lengths = pad_observations(probs)
+        value, ptr = self.forward(np.log(prob.transpose(0, 2, 1) + np.finfo(prob.dtype).tiny), lengths=lengths)
+        states = self.backtrack(ptr, np.argmax(value, axis=1))
+        return [path[:length] for path, length in zip(states, lengths)]
+
+    def forward(self, log_prob: np.ndarray, value: np.ndarray | None = None,
+                lengths: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Viterbi recursion over the frames of log_prob [n_frames, n_states], the log observation likelihoods.
+
+        Silence and every onset are reached from silence or from a sustain, with the same probability for every onset,
+        and the sustain of a note is only reached from its onset or from itself.
+
+        Parameters
+        ----------
+        log_prob : [n_frames, n_states] np.array, or [n_recordings, n_frames, n_states] to decode several recordings,
+            the arguments and the results then have a first n_recordings axis.
+        value : [n_states] np.array, the log probability of the best path ending in every state at the frame before
+            log_prob, as returned by a previous call. The first frame starts from p_init when it is None.
+        lengths : [n_recordings] np.array, the number of frames of every recording, the next frames are padding:
+            their value is the one of the last frame and every state is its own predecessor. No padding when None.
+
+        Returns
+        -------
+        value : [n_states] np.array of float64, the log probability of the best path ending in every state
+            at the last frame.
+        ptr : [n_frames, n_states] np.array, the predecessor of every state at every frame.
+        """
+        if log_prob.ndim == 2:
+            value, ptr = self.forward(log_prob[None], None if value is None else value[None])
+            return value[0], ptr[0]
+
+        epsilon = np.finfo(log_prob.dtype).tiny
+        log_trans = np.log(self.probabilities.astype(log_prob.dtype) + epsilon)
+        stay_silence = log_trans[Situation.SILENCE_to_SILENCE.value]
+        silence_to_onset = log_trans[Situation.SILENCE_to_ONSET.value]
+        onset_to_sustain = log_trans[Situation.ONSET_to_SUSTAIN.value]
+        stay_note = log_trans[Situation.SUSTAIN_to_SUSTAIN.value]
+        sustain_to_silence = log_trans[Situation.SUSTAIN_to_SILENCE.value]
+        sustain_to_onset = log_trans[Situation.SUSTAIN_to_ONSET.value]
+
+        n_recordings, n_frames = log_prob.shape[:2]
+        recordings = np.arange(n_recordings)
+        onsets = np.arange(1, self.n_states, 2)
+        sustains = onsets + 1
+        # the states of every kind are strided views of the states
+        silence_states, onset_states, sustain_states = slice(0, 1), slice(1, None, 2), slice(2, None, 2)
+        ptr = np.zeros((n_recordings, n_frames, self.n_states), dtype=int)
+        padded = None if lengths is None else np.arange(n_frames)[:, None] >= lengths
+        first = 0
+        # the values are accumulated in double precision as in librosa, whatever the precision of log_prob
+        if value is None:
+            value = (log_prob[:, 0] + np.log(self.p_init.astype(log_prob.dtype) + epsilon)).astype(np.float64)
+            first = 1
+        else:
+            value = value.astype(np.float64)
+        for t in range(first, n_frames):
+            previous, frame, frame_ptr = value, log_prob[:, t], ptr[:, t]
+            value = np.empty_like(previous)
+            # silence and the sustains are the only predecessors of silence and of the onsets,
+            # silence wins the ties then the first sustain, as in np.argmax
+            for targets, from_silence, from_sustain in ((silence_states, stay_silence, sustain_to_silence),
+                                                        (onset_states, silence_to_onset, sustain_to_onset)):
+                candidates = previous[:, sustain_states] + from_sustain
+                best = candidates.argmax(axis=1)
+                best_value = candidates[recordings, best]
+                silence_value = previous[:, 0] + from_silence
+                wins = silence_value >= best_value
+                frame_ptr[:, targets] = np.where(wins, 0, sustains[best])[:, None]
+                value[:, targets] = frame[:, targets] + np.where(wins, silence_value, best_value)[:, None]
+            from_onset = previous[:, onset_states] + onset_to_sustain
+            from_sustain = previous[:, sustain_states] + stay_note
+            stay = from_sustain > from_onset
+            frame_ptr[:, sustain_states] = np.where(stay, sustains, onsets)
+            value[:, sustain_states] = frame[:, sustain_states] + np.where(stay, from_sustain, from_onset)
+            if padded is not None and padded[t].any():
+                value[padded[t]] = previous[padded[t]]
+                ptr[padded[t], t] = np.arange(self.n_states)
+        return value, ptr
+
+    @staticmethod
+    def backtrack(ptr: np.ndarray, state: int | np.ndarray) -> np.ndarray:
+        """
+        State of every frame of ptr on the best path ending in state at the last frame.
+        ptr can be the [n_recordings, n_frames, n_states] pointers of several recordings, with their last state.
+        """
+        if ptr.ndim == 2:
+            return NoteHMM.backtrack(ptr[None], np.array([state]))[0]
+        recordings = np.arange(len(ptr))
+        states = np.zeros(ptr.shape[:2], dtype=int)
+        states[:, -1] = state
+        for t in range(ptr.shape[1] - 2, -1, -1):
+            states[:, t] = ptr[recordings, t + 1, states[:, t + 1]]
+        return states
+
+
+def pad_observations(probs: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Stack the observation likelihoods [n_states, n_frames] of several recordings to decode them together.
+
+    Returns
+    -------
+    prob : [n_recordings, n_states, n_frames] np.array, every recording is padded with ones to the longest one.
+    lengths : [n_recordings] np.array, the number of frames of every recording.
+    """
+    lengths = np.array([prob.shape[1] for prob in probs], dtype=int)
+    stacked = np.ones((len(probs), probs[0].shape[0], lengths.max()), dtype=np.result_type(*probs))
+    for index, prob in enumerate(probs):
+        stacked[index, :, :lengths[index]] = prob
+    return stacked, lengths
+
+
+def viterbi_batch(probs: list[np.ndarray], transition: np.ndarray, p_init: np.ndarray | None = None) -> list[np.ndarray]:
+    """
+    Most likely state sequence of every observation likelihoods [n_states, n_frames] of probs for the same dense HMM.
+
+    The recordings are padded to the longest one and decoded together, the padding frames keep the value of the
+    last frame of their recording. The log probabilities and the ties are computed as in librosa.sequence.viterbi,
+    so the sequences are the ones of librosa.sequence.viterbi(prob, transition, p_init=p_init) on every prob,
+    computed in the common dtype of probs.
+    When every state goes to the other states with the same probability, as the chords of ChordIdentifier,
+    a frame costs O(n_states) instead of O(n_states^2), see _uniform_step.
+    """
+    if not probs:
+        return []
+    prob, lengths = pad_observations(probs)
+    n_recordings, n_states, n_frames = prob.shape
+    epsilon = np.finfo(prob.dtype).tiny
+    if p_init is None:
+        p_init = np.full(n_states, 1 / n_states)
+    log_prob = np.log(prob + epsilon).transpose(0, 2, 1)
+    log_trans = np.log(transition + epsilon)
+    stay = np.diagonal(log_trans)
+    move = np.append(log_trans[0, 1:2], log_trans[1:, 0])
+    if n_states > 1 and np.array_equal(log_trans, np.where(np.eye(n_states, dtype=bool), stay[:, None], move[:, None])):
+        step = lambda value: _uniform_step(value, stay, move)
+    else:
+        step = lambda value: _dense_step(value, log_trans)
+    padded = np.arange(n_frames)[:, None] >= lengths
+    # the values are accumulated in double precision as in librosa
+    value = (log_prob[:, 0] + np.log(p_init + epsilon)).astype(np.float64)
+    ptr = np.zeros((n_recordings, n_frames, n_states), dtype=int)
+    for t in range(1, n_frames):
+        previous = value
+        ptr[:, t], value = step(previous)
+        value += log_prob[:, t]
+        if padded[t].any():
+            value[padded[t]] = previous[padded[t]]
+            ptr[padded[t], t] = np.arange(n_states)
+    states = NoteHMM.backtrack(ptr, np.argmax(value, axis=1))
+    return [path[:length] for path, length in zip(states, lengths)]
+
+
+def _dense_step(value: np.ndarray, log_trans: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Best predecessor of every state and the log probability of its path, from the values [n_recordings, n_states]
+    of the previous frame.
+    """
+    # trans_out[:, j, k] is the best path ending in k then going to j
+    trans_out = value[:, None, :] + log_trans.T
+    ptr = np.argmax(trans_out, axis=2)
+    return ptr, np.take_along_axis(trans_out, ptr[..., None], axis=2)[..., 0]
+
+
+def _uniform_step(value: np.ndarray, stay: np.ndarray, move: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    _dense_step when the state k stays with the log probability stay[k] and goes to any other state with move[k].
+
+    The best predecessor of j other than j is the best move, or the second best one for the state of the best move.
+    """
+    recordings = np.arange(len(value))
+    states = np.arange(value.shape[1])
+    from_move = value + move
+    first = np.argmax(from_move, axis=1)
+    first_value = from_move[recordings, first]
+    from_move[recordings, first] = -np.inf
+    second = np.argmax(from_move, axis=1)
+    is_first = states == first[:, None]
+    other = np.where(is_first, second[:, None], first[:, None])
+    other_value = np.where(is_first, from_move[recordings, second][:, None], first_value[:, None])
+    from_stay = value + stay
+    # the smallest state wins the ties, as in np.argmax
+    stays = (from_stay > other_value) | ((from_stay == other_value) & (states < other))
+    return np.where(stays, states, other), np.where(stays, from_stay, other_value)
+
+
+@lru_cache(maxsize=None)
+def note_hmm(n_notes: int, prob_stay_note: float = 0.9, prob_stay_silence: float = 0.5) -> NoteHMM:
+    """
+    The NoteHMM of these parameters, built once and shared by every caller.
+    """
+    return NoteHMM(n_notes, prob_stay_note, prob_stay_silence)
+
+
 def build_transition_matrix( n_notes: int, prob_stay_note=0.9, prob_stay_silence=0.5):
 
     """
@@ -73,29 +362,9 @@ def build_transition_matrix( n_notes: int, prob_stay_note=0.9, prob_stay_silence
     Return
     ------
     transition_matrix : 2D np.array
-        The transition matrix for the HMM model.
+        The transition matrix for the HMM model, a copy of the one of note_hmm.
     """
-    # state 1, 3, 5 ... are onsets
-    # state 2, 4, 6 ... are sustains
-    N = 2 * n_notes + 1  # +1 for silence state
-    transition_matrix = np.zeros((N,N))
-
-    for i in range(N):
-        for j in range(N):
-            match classify_case(i,j):
-                case Situation.SILENCE_to_SILENCE:
-                    transition_matrix[i,j] = prob_stay_silence
-                case Situation.SILENCE_to_ONSET:
-                    transition_matrix[i,j] = (1 - prob_stay_silence)/n_notes
-                case Situation.ONSET_to_SUSTAIN: # assuming window is to small to go from onset to onset or onset to silence
-                    transition_matrix[i,j] = 1
-                case Situation.SUSTAIN_to_SUSTAIN:
-                    transition_matrix[i,j] = prob_stay_note
-                case Situation.SUSTAIN_to_SILENCE:
-                    transition_matrix[i,j] = (1 - prob_stay_note)/(n_notes+1)
-                case Situation.SUSTAIN_to_ONSET:
-                    transition_matrix[i,j] = (1 - prob_stay_note)/(n_notes+1)
-    return transition_matrix
+    return note_hmm(n_notes, prob_stay_note, prob_stay_silence).transition_matrix.copy()
 
 
 
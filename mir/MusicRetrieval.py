@@ -8,7 +8,14 @@ from enum import Enum
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from mir.MIR_lib import  Situation, Note_State, MusicDynamics, build_transition_matrix, classify_case
+from mir.MIR_lib import  Situation, Note_State, MusicDynamics, NoteHMM, note_hmm
+from mir.Cache import feature_cache, file_digest
+from functools import cached_property, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import soundfile as sf
+import soxr
+from scipy.signal import resample_poly
 import matplotlib.pyplot as plt
 # TODO utiliser la librairy HMMlearn pour implémenter un modèle HMM
 # from hmmlearn import hmm
@@ -58,7 +65,17 @@ class AudioParams:
     window_length : int
     hop_length : int
         Parameters for FFT estimation
+    cache : FeatureCache
+        On-disk cache of the features, see mir.Cache
+    precision : str, 'double' or 'single'
+        Floating point precision of the pipeline, 'single' keeps the signals, spectra, correlations,
+        HMM probabilities and piano rolls in float32/complex64.
+        Set AudioParams.precision to change it for every estimator at once.
+    bandwidth : float
+        Highest frequency analysed by the estimator, its signals are decimated down to it, see decimation.
     """
+    precision: str = "double"
+
     def __init__(self):
         self.sampling_rate: int = 22050
         self.note_min = Note("E", 2)
@@ -67,23 +84,324 @@ class AudioParams:
         self.hop_length: int = 512
         self.window_length = int(self.frame_length / 2)
         self.hop_time = self.hop_length / self.sampling_rate
+        self.cache = feature_cache
     @property
     def n_notes(self):
         return self.note_max.midi - self.note_min.midi + 1
 
+    @property
+    def float_dtype(self) -> type:
+        if self.precision not in ("double", "single"):
+            raise ValueError(f"Invalid precision: {self.precision}, please use 'double' or 'single'")
+        return np.float32 if self.precision == "single" else np.float64
+
+    @property
+    def complex_dtype(self) -> type:
+        return np.complex64 if self.float_dtype == np.float32 else np.complex128
+
+    @property
+    def bandwidth(self) -> float:
+        return self.sampling_rate / 2
+
+    def decimation(self, bandwidth: float | None = None) -> int:
+        """
+        Largest power of two the signals can be decimated by while keeping bandwidth (the bandwidth of the estimator
+        by default) in the pass band of the anti-aliasing filter, 90 % of the decimated Nyquist frequency.
+        hop_length, frame_length and window_length stay multiples of the factor so the frames keep the same times.
+        """
+        bandwidth = self.bandwidth if bandwidth is None else bandwidth
+        factor = 1
+        while (all(length % (2 * factor) == 0 for length in (self.hop_length, self.frame_length, self.window_length))
+               and 0.9 * self.sampling_rate / (4 * factor) >= bandwidth):
+            factor *= 2
+        return factor
+
 class AudioSignal(AudioParams):
     def __init__(self, audio: str | np.ndarray):
         super(AudioSignal,self).__init__()
+        # the precision is fixed when the signal is loaded, the estimators built on it follow the signal
+        self.precision = self.precision
         if type(audio) == np.ndarray:
             self.y = audio
         elif type(audio) == str:
-            self.y, _ = librosa.load(audio, sr=self.sampling_rate)
+            self.y = self.load(audio)
         else:
             raise ValueError("Audio must be a path to a file or a numpy array")
-        self.y_harmonic = librosa.effects.harmonic(self.y)
-        self.y_percussive = librosa.effects.percussive(self.y)
-        tempo =  librosa.feature.tempo(y=self.y_percussive, sr=self.sampling_rate, hop_length=self.hop_length)
-        self.tempo = tempo[0] if type(tempo) == np.ndarray else tempo
+        if self.float_dtype == np.float32:
+            self.y = self.y.astype(np.float32, copy=False)
+
+    def load(self, path: str) -> np.ndarray:
+        """
+        Decode the audio file at path to a mono signal at sampling_rate.
+        The decoded signal is kept in the feature cache under the hash of the file and opened memory mapped (read only)
+        on the next loads, the file is only decoded again if its content changes.
+        """
+        if not self.cache.enabled:
+            return librosa.load(path, sr=self.sampling_rate)[0]
+        params = {"sampling_rate": self.sampling_rate, "mono": True, "res_type": "soxr_hq"}
+        return self.cache.get("decoded_audio", file_digest(path), params,
+                              lambda: librosa.load(path, sr=self.sampling_rate)[0])
+
+    @cached_property
+    def hpss(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Harmonic and percussive components of y, separated from a single STFT and median filtering pass.
+        """
+        return librosa.effects.hpss(self.y)
+
+    @property
+    def y_harmonic(self) -> np.ndarray:
+        return self.hpss[0]
+
+    @property
+    def y_percussive(self) -> np.ndarray:
+        return self.hpss[1]
+
+    @cached_property
+    def features(self) -> "FeatureStore":
+        """
+        Features of the recording shared by every estimator built on it, see FeatureStore.
+        """
+        return FeatureStore(self)
+
+    @cached_property
+    def tempo(self) -> float:
+        tempo =  librosa.feature.tempo(onset_envelope=self.features.onset_envelope(), sr=self.sampling_rate,
+                                       hop_length=self.hop_length)
+        return tempo[0] if type(tempo) == np.ndarray else tempo
+
+    @cached_property
+    def digest(self) -> str:
+        """
+        Hash of the decoded samples, identifies the audio content in the feature cache.
+        """
+        return hashlib.sha256(np.ascontiguousarray(self.y).tobytes()).hexdigest()
+
+class FeatureStore:
+    """
+    Features of a recording computed once and shared by Mono, Pseudo2D and ChordIdentifier.
+
+    The base representations are computed from the signals of the recording and the other features are derived
+    from them, ex: the chroma is folded from the high resolution cqt. Every feature also goes through the
+    on-disk feature cache, see mir.Cache.
+    ----------
+    Methods:
+        get(name, params, compute) -> return : np.ndarray
+        signal(source, factor) -> return : np.ndarray
+        n_frames(source) -> return : int
+        tuning(source) -> return : float
+        cqt(source) -> return : [n_octaves * n_bins_per_octave, M] np.array
+        chroma(source) -> return : [12, M] np.array
+        onset_envelope() -> return : [M] np.array
+        onsets() -> return : np.array of the onset frames
+    """
+    # resolution and range of the high resolution cqt, librosa.feature.chroma_cqt covers the same 7 octaves
+    n_bins_per_octave = 36
+    n_octaves = 7
+    fmin = Note("C", 1)
+
+    def __init__(self, audio: "AudioSignal"):
+        self.audio = audio
+        self.features = {}
+
+    def get(self, name: str, params: dict, compute) -> np.ndarray:
+        """
+        Returns the feature name of the recording, compute() is only called the first time the feature is needed
+        and if it is not in the feature cache.
+
+        Parameters
+        ----------
+        name : name of the feature, ex: 'chroma'
+        params : every parameter affecting the result of compute
+        compute : callable returning the feature as a np.ndarray
+        """
+        key = self.audio.cache.key(name, self.audio.digest, params)
+        if key not in self.features:
+            self.features[key] = self.audio.cache.get(name, self.audio.digest, params, compute)
+        return self.features[key]
+
+    def signal(self, source: str = "y", factor: int = 1) -> np.ndarray:
+        """
+        Signal of the recording decimated by factor with a polyphase filter, source is 'y', 'y_harmonic' or 'y_percussive'.
+        Every decimated signal is derived from the same decoded signal, see AudioParams.decimation for the factor.
+        """
+        y = getattr(self.audio, source)
+        if factor == 1:
+            return y
+        params = {"source": source, "sampling_rate": self.audio.sampling_rate, "factor": factor}
+        return self.get("decimated_signal", params, lambda: resample_poly(y, 1, factor).astype(y.dtype, copy=False))
+
+    def n_frames(self, source: str = "y") -> int:
+        """
+        Number of frames of the features of source, the same whatever the decimation.
+        """
+        return 1 + len(getattr(self.audio, source)) // self.audio.hop_length
+
+    def tuning(self, source: str = "y") -> float:
+        """
+        Deviation of a signal of the recording from A440, in fractions of a bin of the high resolution cqt.
+        It is estimated on the signal at full rate, as librosa.feature.chroma_cqt does.
+        """
+        audio = self.audio
+        params = {"source": source, "sampling_rate": audio.sampling_rate, "n_bins_per_octave": self.n_bins_per_octave}
+        return float(self.get("tuning", params, lambda: np.array(librosa.estimate_tuning(
+            y=getattr(audio, source), sr=audio.sampling_rate, bins_per_octave=self.n_bins_per_octave))))
+
+    def cqt(self, source: str = "y") -> np.ndarray:
+        """
+        High resolution constant-Q transform of a signal of the recording, source is 'y', 'y_harmonic' or 'y_percussive'.
+        The bins follow the tuning of the signal and the signal is decimated down to the top of the cqt.
+        """
+        audio = self.audio
+        factor = audio.decimation(self.fmin.hz * 2 ** self.n_octaves)
+        tuning = self.tuning(source)
+        params = {"source": source, "sampling_rate": audio.sampling_rate, "hop_length": audio.hop_length,
+                  "fmin": self.fmin.string, "n_bins_per_octave": self.n_bins_per_octave, "n_octaves": self.n_octaves,
+                  "tuning": tuning, "decimation": factor, "dtype": audio.complex_dtype}
+        return self.get("high_resolution_cqt", params, lambda: librosa.cqt(
+            self.signal(source, factor), sr=audio.sampling_rate / factor, hop_length=audio.hop_length // factor,
+            fmin=self.fmin.hz, n_bins=self.n_octaves * self.n_bins_per_octave, bins_per_octave=self.n_bins_per_octave,
+            tuning=tuning, dtype=audio.complex_dtype)[:, :self.n_frames(source)])
+
+    def chroma(self, source: str = "y") -> np.ndarray:
+        """
+        Chroma of a signal of the recording, folded from its high resolution cqt and normalized by its maximum.
+        """
+        def compute():
+            folding = librosa.filters.cq_to_chroma(self.n_octaves * self.n_bins_per_octave,
+                                                   bins_per_octave=self.n_bins_per_octave, fmin=self.fmin.hz)
+            chroma = folding.astype(self.audio.float_dtype) @ np.abs(self.cqt(source))
+            return librosa.util.normalize(chroma, norm=np.inf, axis=0)
+        params = {"source": source, "sampling_rate": self.audio.sampling_rate, "hop_length": self.audio.hop_length,
+                  "folded_from": "high_resolution_cqt", "dtype": self.audio.float_dtype}
+        return self.get("chroma", params, compute)
+
+    def onset_envelope(self) -> np.ndarray:
+        """
+        Onset strength of the percussive signal, shared by the tempo estimation and the onset detection.
+        """
+        audio = self.audio
+        params = {"source": "y_percussive", "sampling_rate": audio.sampling_rate, "hop_length": audio.hop_length}
+        return self.get("onset_strength", params, lambda: librosa.onset.onset_strength(
+            y=audio.y_percussive, sr=audio.sampling_rate, hop_length=audio.hop_length))
+
+    def onsets(self) -> np.ndarray:
+        """
+        Onset frames of the percussive signal, backtracked to the previous minimum of the onset strength.
+        """
+        return librosa.onset.onset_detect(onset_envelope=np.asarray(self.onset_envelope()), sr=self.audio.sampling_rate,
+                                          hop_length=self.audio.hop_length, backtrack=True)
+
+
+class AudioStream(AudioParams):
+    """
+    Audio file decoded and resampled block by block, the memory used does not depend on the length of the file.
+    The samples are the same as the ones of AudioSignal(path).y.
+    ----------
+    Methods:
+        decode() -> return : generator of the resampled samples, in chunks of varying size
+        blocks() -> return : generator of np.ndarray(block_size,)
+        head(n_samples) -> return : np.ndarray(n_samples,)
+        tempo(n_samples) -> return : float
+    ----------
+    attributes:
+        native_sampling_rate -> return : int
+        n_samples -> return : number of samples after resampling
+    """
+    def __init__(self, path: str, block_size: int = 2**16):
+        super(AudioStream, self).__init__()
+        self.path = path
+        self.block_size = block_size
+        info = sf.info(path)
+        self.native_sampling_rate = info.samplerate
+        self.n_native_samples = info.frames
+
+    @property
+    def n_samples(self) -> int:
+        return int(np.ceil(self.n_native_samples * self.sampling_rate / self.native_sampling_rate))
+
+    def decode(self):
+        """
+        Generator of the samples of the file as a mono signal resampled to sampling_rate, in chunks of varying size.
+
+        The resampler keeps its state between the blocks read from the file, the chunks put end to end are the
+        signal resampled in one go like librosa.load does.
+        """
+        resampler = None
+        if self.native_sampling_rate != self.sampling_rate:
+            resampler = soxr.ResampleStream(self.native_sampling_rate, self.sampling_rate, 1, dtype='float32',
+                                            quality='HQ')
+        native_block_size = int(np.ceil(self.block_size * self.native_sampling_rate / self.sampling_rate))
+        with sf.SoundFile(self.path) as f:
+            for block in f.blocks(blocksize=native_block_size, dtype='float32', always_2d=True):
+                y = librosa.to_mono(block.T)
+                yield y if resampler is None else resampler.resample_chunk(y)
+        if resampler is not None:
+            yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+    def blocks(self):
+        """
+        Generator of the samples of the file in blocks of block_size samples, the last one may be shorter.
+        The next block is decoded in a background thread while the current one is analysed.
+        """
+        pending, size = [], 0
+        for chunk in prefetch(self.decode()):
+            pending.append(chunk)
+            size += len(chunk)
+            if size < self.block_size:
+                continue
+            samples = np.concatenate(pending)
+            full = size - size % self.block_size
+            for start in range(0, full, self.block_size):
+                yield samples[start:start + self.block_size]
+            pending, size = [samples[full:]], size - full
+        if size > 0:
+            yield np.concatenate(pending)
+
+    def head(self, n_samples: int) -> np.ndarray:
+        """
+        The first n_samples samples of the file, only the blocks containing them are decoded.
+        """
+        head, size = [], 0
+        for block in self.blocks():
+            if size >= n_samples:
+                break
+            head.append(block)
+            size += len(block)
+        return np.concatenate(head)[:n_samples] if head else np.zeros(0, dtype=np.float32)
+
+    def tempo(self, n_samples: int) -> float:
+        """
+        Tempo estimated on the first n_samples samples of the file.
+        """
+        tempo = librosa.feature.tempo(y=librosa.effects.percussive(self.head(n_samples)), sr=self.sampling_rate,
+                                      hop_length=self.hop_length)
+        return tempo[0] if type(tempo) == np.ndarray else tempo
+
+
+@lru_cache(maxsize=None)
+def state_names(note_min: int, n_notes: int) -> np.ndarray:
+    """
+    Name of every state of the note HMM with n_notes notes from the midi note note_min:
+    'N' for silence, the name of the note for its onset (odd states) and its sustain (even states).
+    The table is shared, it is read only.
+    """
+    names = np.array(["N", *np.repeat(librosa.midi_to_note(np.arange(n_notes) + note_min), 2)])
+    names.flags.writeable = False
+    return names
+
+
+def prefetch(iterator):
+    """
+    Yields the items of iterator, the next item is computed in a background thread while the current one is used.
+    """
+    done = object()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(next, iterator, done)
+        while (item := future.result()) is not done:
+            future = pool.submit(next, iterator, done)
+            yield item
+
 
 class MonoParams(AudioParams):
 
@@ -97,17 +415,165 @@ class MonoParams(AudioParams):
     spread : float, between 0 and 1
         Probability that the singer/musician had a one-semitone deviation
         due to vibrato or glissando.
+    prob_stay_note : float, between 0 and 1
+        Probability of staying in the same note state.
+    prob_stay_silence : float, between 0 and 1
+        Probability of staying in the silence state.
+    pitch_backend : str, 'pyin' or 'yin'
+        Pitch estimator, 'yin' is a batched FFT-based YIN, much faster than librosa.pyin but slightly less accurate.
+    yin_threshold : float, between 0 and 1
+        Threshold of the cumulative mean normalized difference under which a frame is voiced, for the 'yin' backend.
     """
+    pitch_backends = ("pyin", "yin")
+
     def __init__(self):
         super(MonoParams,self).__init__()
         self.pitch_acc: float = 0.9
         self.voiced_acc: float = 0.9
         self.onset_acc: float = 0.9
         self.spread: float = 0.2
+        self.prob_stay_note: float = 0.9
+        self.prob_stay_silence: float = 0.5
+        self.pitch_backend: str = "pyin"
+        self.yin_threshold: float = 0.3
         self.onset_slice = slice(1,None,2)
         self.sustain_slice = slice(2,None,2)
         self.silence_slice = 0
 
+    @property
+    def bandwidth(self) -> float:
+        # the fundamental and the first overtone of the highest note
+        return 2 * self.note_max.hz
+
+    @property
+    def hmm(self) -> NoteHMM:
+        """
+        HMM of the note states, shared by the estimators with the same number of notes and probabilities.
+        """
+        return note_hmm(self.n_notes, self.prob_stay_note, self.prob_stay_silence)
+
+    def pitch_track(self, y: np.ndarray, factor: int = 1) -> np.ndarray:
+        """
+        Pitch and voicing of the harmonic signal y, decimated by factor (see AudioParams.decimation), with the pitch backend.
+        Returns [f0, voiced_flag, voiced_prob] stacked, one column per frame, f0 is nan in the unvoiced frames.
+
+        Raises:
+            ValueError: if the pitch backend is unknown.
+        """
+        if self.pitch_backend not in self.pitch_backends:
+            raise ValueError(f"Unknown pitch backend: {self.pitch_backend}, please use one of {self.pitch_backends}")
+        if self.pitch_backend == "yin":
+            return self.yin_track(y, factor)
+        f0, voiced_flag, voiced_prob = librosa.pyin(
+                y=y, fmin=float(self.note_min.hz * 0.9), fmax=float(self.note_max.hz * 1.1),
+                sr=self.sampling_rate / factor, frame_length=self.frame_length // factor,
+                win_length=self.window_length // factor, hop_length=self.hop_length // factor)
+        return np.stack((f0, voiced_flag, voiced_prob))
+
+    def yin_track(self, y: np.ndarray, factor: int = 1, batch_size: int = 512) -> np.ndarray:
+        """
+        YIN of the harmonic signal y decimated by factor, on the frames of pyin, batch_size frames at a time.
+
+        The difference function of every frame of a batch is computed at once from the FFT of the frames,
+        the period is the first dip of the cumulative mean normalized difference under yin_threshold,
+        refined by parabolic interpolation. The voicing probability is 1 - the normalized difference at the period.
+        Returns [f0, voiced_flag, voiced_prob] stacked as pitch_track.
+        """
+        sr = self.sampling_rate / factor
+        frame_length, win_length = self.frame_length // factor, self.window_length // factor
+        min_period = max(int(np.floor(sr / (self.note_max.hz * 1.1))), 1)
+        max_period = min(int(np.ceil(sr / (self.note_min.hz * 0.9))), frame_length - win_length - 1)
+        # centered frames, as librosa.pyin
+        frames = librosa.util.frame(np.pad(y, frame_length // 2), frame_length=frame_length,
+                                    hop_length=self.hop_length // factor)
+        n_fft = 2 ** int(np.ceil(np.log2(frame_length + win_length)))
+        lags = np.arange(1, max_period + 2)
+        f0 = np.full(frames.shape[1], np.nan)
+        voiced_prob = np.zeros(frames.shape[1])
+        for start in range(0, frames.shape[1], batch_size):
+            batch = frames[:, start:start + batch_size].T.astype(np.float64)
+            # correlation of the first win_length samples with the frame at every lag
+            correlation = np.fft.irfft(np.fft.rfft(batch, n_fft) * np.conj(np.fft.rfft(batch[:, :win_length], n_fft)),
+                                       n_fft)[:, :max_period + 2]
+            energy = np.cumsum(np.pad(batch ** 2, ((0, 0), (1, 0))), axis=1)
+            window_energy = energy[:, win_length:win_length + max_period + 2] - energy[:, :max_period + 2]
+            difference = window_energy[:, :1] + window_energy[:, lags] - 2 * correlation[:, lags]
+            # cumulative mean normalized difference, difference[:, k] is the difference at lag k + 1,
+            # it is 1 (aperiodic) where the frame is silent
+            cumulative = np.cumsum(difference, axis=1)
+            silent = cumulative <= np.finfo(float).eps * window_energy[:, :1]
+            normalized = np.where(silent, 1, difference * lags / np.where(silent, 1, cumulative))
+            candidates = normalized[:, min_period - 1:max_period]
+            # first local minimum under the threshold, the global minimum if there is none
+            dips = np.zeros(candidates.shape, dtype=bool)
+            dips[:, 1:-1] = (candidates[:, 1:-1] < candidates[:, :-2]) & (candidates[:, 1:-1] <= candidates[:, 2:])
+            dips &= candidates < self.yin_threshold
+            index = np.where(np.any(dips, axis=1), np.argmax(dips, axis=1), np.argmin(candidates, axis=1))
+            rows = np.arange(len(index))
+            aperiodicity = candidates[rows, index]
+            # parabolic interpolation of the period around the dip
+            before = candidates[rows, np.maximum(index - 1, 0)]
+            after = candidates[rows, np.minimum(index + 1, candidates.shape[1] - 1)]
+            curvature = before - 2 * aperiodicity + after
+            shift = np.where(curvature > 0, 0.5 * (before - after) / np.where(curvature > 0, curvature, 1), 0)
+            period = min_period + index + np.clip(shift, -0.5, 0.5)
+            voiced = aperiodicity < self.yin_threshold
+            f0[start:start + len(index)] = np.where(voiced, sr / period, np.nan)
+            voiced_prob[start:start + len(index)] = np.clip(1 - aperiodicity, 0, 1)
+        return np.stack((f0, ~np.isnan(f0), voiced_prob))
+
+    def build_priors(self, pitch: np.ndarray, voiced_flag: np.ndarray, voiced_prob: np.ndarray,
+                     onset_flags: np.ndarray, tuning: float) -> np.ndarray:
+        """
+        Priors matrix [2 * n_notes + 1, n_frames] of the note states from the pitch and voicing estimated by pyin
+        and the onset frames.
+        """
+        f0_ = np.round(librosa.hz_to_midi(pitch - tuning)).astype(int)
+
+        priors = np.zeros((self.n_notes * 2 + 1, len(pitch)), dtype=self.float_dtype)
+
+        priors[self.silence_slice, ~voiced_flag] = self.voiced_acc
+        priors[self.silence_slice, voiced_flag] = 1 - self.voiced_acc
+
+        priors[self.onset_slice, onset_flags] = self.onset_acc  # Set priors for onsets
+        priors[self.onset_slice, ~onset_flags] = (1 - self.onset_acc) / self.n_notes  # Set priors for non-onsets
+
+        # distance in semitones between the note of every sustain state and the pitch of every frame
+        distance = (np.arange(self.n_notes) + self.note_min.midi)[:, None] - f0_[None, :]
+        sustain_flag = distance == 0
+        spread_flag = np.abs(distance) == 1
+        priors[self.sustain_slice] = np.where(
+            sustain_flag, voiced_prob * self.pitch_acc,
+            np.where(spread_flag, voiced_prob * self.pitch_acc * self.spread,
+                     (1 - self.pitch_acc * voiced_prob) / self.n_notes))
+
+        # Normalize priors for each frame
+
+        priors /= np.sum(priors, axis=0, keepdims=True)
+        return priors
+
+    @property
+    def state_names(self) -> np.ndarray:
+        """
+        Name of every state of the HMM, see state_names.
+        """
+        return state_names(self.note_min.midi, self.n_notes)
+
+    def state_notes(self, states: np.ndarray) -> np.ndarray:
+        """
+        Note of every state of states, 'N' for silence, the onset and the sustain of a note give the same note.
+        """
+        return self.state_names[states]
+
+    def state_piano_roll(self, states: np.ndarray) -> np.ndarray:
+        """
+        Piano roll [n_notes, n_frames] of a state path, 1 where the onset or the sustain of a note is decoded.
+        """
+        piano_roll = np.zeros((self.n_notes, len(states)), dtype=self.float_dtype)
+        frames = np.flatnonzero(states > 0)
+        piano_roll[(states[frames] - 1) // 2, frames] = 1
+        return piano_roll
+
 
 
 class Mono(MonoParams):
@@ -117,21 +583,33 @@ class Mono(MonoParams):
     Methods:
         prepare_chroma() -> return : chroma
         pyin() -> return : f0, voiced_flag, voiced_prob
+        decode_batch(monos) -> return : state path of every recording
     ----------
     attributes:
+        hmm -> return : NoteHMM
         priors -> return : np.array
         transition_matrix -> return : [2N+1, 12N+1] np.array
         p_init -> return : np.array
         simple_notation -> return : [()...()]
         pianoroll -> return : (slience, onset, sustain)
     """
-    def __init__(self, audio: AudioSignal):
+    def __init__(self, audio: AudioSignal, pitch_backend: str = "pyin"):
         super(Mono, self).__init__()
-        self.audio_harmonic = audio.y_harmonic
-        self.audio_percussive = audio.y_percussive
+        self.pitch_backend = pitch_backend
+        self.precision = audio.precision
+        self.digest = audio.digest
+        self.audio = audio
         self.pitch, self.voiced_flag, self.voiced_prob = self.pyin()
         self.tuning = librosa.pitch_tuning(self.pitch)
 
+    @property
+    def audio_harmonic(self) -> np.ndarray:
+        return self.audio.y_harmonic
+
+    @property
+    def audio_percussive(self) -> np.ndarray:
+        return self.audio.y_percussive
+
     def prepare_chroma(self):
         chroma = librosa.feature.chroma_cqt(y=self.audio_harmonic, sr=self.sampling_rate, hop_length=self.hop_length,
             tuning=self.tuning, threshold=0.4, n_octaves=4, bins_per_octave=12, fmin=self.note_min.hz)
@@ -139,21 +617,29 @@ class Mono(MonoParams):
         return chroma
 
     def pyin(self):
-        f0, voiced_flag, voiced_prob = librosa.pyin(
-                y=self.audio_harmonic, fmin=float(self.note_min.hz * 0.9), fmax=float(self.note_max.hz * 1.1),
-                sr=self.sampling_rate, frame_length=self.frame_length, win_length=self.window_length,
-                hop_length=self.hop_length)
-        return f0, voiced_flag, voiced_prob
+        """
+        Pitch and voicing of the harmonic signal with the pitch backend, see MonoParams.pitch_track.
+        """
+        factor = self.decimation()
+        def compute():
+            return self.pitch_track(self.audio.features.signal("y_harmonic", factor),
+                                    factor)[:, :self.audio.features.n_frames("y_harmonic")]
+        params = {"source": "y_harmonic", "sampling_rate": self.sampling_rate, "note_min": self.note_min.string,
+                  "note_max": self.note_max.string, "frame_length": self.frame_length,
+                  "window_length": self.window_length, "hop_length": self.hop_length, "decimation": factor}
+        if self.pitch_backend == "yin":
+            params["yin_threshold"] = self.yin_threshold
+        f0, voiced_flag, voiced_prob = self.audio.features.get(self.pitch_backend, params, compute)
+        return f0.astype(self.float_dtype), voiced_flag.astype(bool), voiced_prob.astype(self.float_dtype)
 
     def no_hmm(self, threshold=0.7) -> np.ndarray:
         pitch, voiced_flag, voiced_prob = (self.pitch, self.voiced_flag, self.voiced_prob)
 
-        f0_ = np.round(librosa.hz_to_midi(pitch - self.tuning)).astype(int)
-        # make a pinaoroll with the notes
-        pianoroll = np.zeros((self.n_notes, len(pitch)))
-        for index, (note, voice) in enumerate(list(zip(f0_, voiced_flag))):
-            pianoroll[note - self.note_min.midi, index] = 1 if ( voiced_prob[index] > threshold) else 0
-            #print(note, voice, voiced_prob[index])
+        note = np.round(librosa.hz_to_midi(pitch - self.tuning)) - self.note_min.midi
+        # make a pinaoroll with the notes, the unvoiced frames (nan pitch) and the notes out of range stay empty
+        pianoroll = np.zeros((self.n_notes, len(pitch)), dtype=self.float_dtype)
+        frames = np.flatnonzero((note >= 0) & (note < self.n_notes) & (voiced_prob > threshold))
+        pianoroll[note[frames].astype(int), frames] = 1
         return pianoroll
 
     def show_piano_roll(self):
@@ -177,106 +663,54 @@ class Mono(MonoParams):
         self : a Prior object
 
         """
-        # pitch and voicing
-        pitch, voiced_flag, voiced_prob = (self.pitch, self.voiced_flag, self.voiced_prob)
-
-        f0_ = np.round(librosa.hz_to_midi(pitch - self.tuning)).astype(int)
-        onsets = librosa.onset.onset_detect(
-            y=self.audio_percussive, sr=self.sampling_rate,
-            hop_length=self.hop_length, backtrack=True)
-
-        priors = np.zeros((self.n_notes * 2 + 1, len(pitch)))
-
-        priors[self.silence_slice, ~voiced_flag] = self.voiced_acc
-        priors[self.silence_slice, voiced_flag] = 1 - self.voiced_acc
-
-        onset_flags = np.zeros(len(pitch), dtype=bool)
-        onset_flags[onsets] = True
-
-        priors[self.onset_slice, onset_flags] = self.onset_acc  # Set priors for onsets
-        priors[self.onset_slice, ~onset_flags] = (1 - self.onset_acc) / self.n_notes  # Set priors for non-onsets
-        # TODO remove for loop and vectorize the procedure
-        sustain_indices = np.arange(self.n_notes) + self.note_min.midi
-
-        for j in range(self.n_notes):
-            sustain_flag = (sustain_indices[j] == f0_)
-            spread_flag = (np.abs(sustain_indices[j] - f0_) == 1)
-            priors[(j*2) + 2, sustain_flag] = voiced_prob[sustain_flag] * self.pitch_acc
-            priors[(j*2) + 2, spread_flag] = voiced_prob[spread_flag] * self.pitch_acc * self.spread
-            priors[(j*2) + 2, ~sustain_flag & ~spread_flag] = (1 - self.pitch_acc * voiced_prob[~sustain_flag & ~spread_flag]) / self.n_notes
-
-        # Normalize priors for each frame
-
-        priors /= np.sum(priors, axis=0, keepdims=True)
-        return priors
+        onset_flags = np.zeros(len(self.pitch), dtype=bool)
+        onset_flags[self.audio.features.onsets()] = True
+        return self.build_priors(self.pitch, self.voiced_flag, self.voiced_prob, onset_flags, self.tuning)
 
     @property
-    def transition_matrix(self):
-
+    def transition_matrix(self) -> np.array:
         """
-        Initialize the transition matrix for the HMM model.
-
-        Parameters
-        ----------
-        prob_stay_note : float
-            The probability of staying in the same note state.
-        prob_stay_silence : float
-            The probability of staying in the silence state.
-        Return
-        ------
-        transition_matrix : 2D np.array
-            The transition matrix for the HMM model.
-        """
-        # state 1, 3, 5 ... are onsets
-        # state 2, 4, 6 ... are sustains
-        N = 2 * self.n_notes + 1  # +1 for silence state
-        transition_matrix = np.zeros((N,N))
-
-        prob_stay_note=0.9
-        prob_stay_silence=0.5
-
-        for i in range(N):
-            for j in range(N):
-                match classify_case(i,j):
-                    case Situation.SILENCE_to_SILENCE:
-                        transition_matrix[i,j] = prob_stay_silence
-                    case Situation.SILENCE_to_ONSET:
-                        transition_matrix[i,j] = (1 - prob_stay_silence)/self.n_notes
-                    case Situation.ONSET_to_SUSTAIN: # assuming window is to small to go from onset to onset or onset to silence
-                        transition_matrix[i,j] = 1
-                    case Situation.SUSTAIN_to_SUSTAIN:
-                        transition_matrix[i,j] = prob_stay_note
-                    case Situation.SUSTAIN_to_SILENCE:
-                        transition_matrix[i,j] = (1 - prob_stay_note)/(self.n_notes+1)
-                    case Situation.SUSTAIN_to_ONSET:
-                        transition_matrix[i,j] = (1 - prob_stay_note)/(self.n_notes+1)
-        return transition_matrix
+        Transition matrix of the HMM model, see NoteHMM.
+        """
+        return self.hmm.transition_matrix.astype(self.float_dtype, copy=False)
 
     @property
     def p_init(self) -> np.array:
         """
         Initialise initial probabilities with uniform distribution over onset and silence states
         """
-        p_init = np.zeros(self.transition_matrix.shape[0])
-        p =  1/ (self.n_notes + 1)
-        p_init[0] = p
-        p_init[1::2] = p
-        return p_init
+        return self.hmm.p_init.astype(self.float_dtype, copy=False)
+
+    @property
+    def encoded_states(self) -> np.ndarray:
+        """
+        Decode the HMM, return the state path of the recording (integers, see state_notes), also set as encoded_state.
+        """
+        self.encoded_state = self.hmm.viterbi(self.priors)
+        return self.encoded_state
 
     @property
     def decoded_states(self):
         """return a list of note value."""
-        self.encoded_state = librosa.sequence.viterbi(self.priors, self.transition_matrix, p_init=self.p_init)
-        result = []
-        for i in self.encoded_state:
-            if i == 0:
-                result.append("N")
-            elif i % 2 == 0:
-                result.append(librosa.midi_to_note(i // 2 - 1 + self.note_min.midi))
-            else:
-                result.append(librosa.midi_to_note(i // 2 + self.note_min.midi))
+        return self.state_notes(self.encoded_states)
 
-        return np.array(result)
+    @staticmethod
+    def decode_batch(monos: list["Mono"]) -> list[np.ndarray]:
+        """
+        Decode the HMM of several recordings at once, see NoteHMM.viterbi_batch.
+        The recordings sharing the same model and precision are decoded in a single call.
+
+        Returns
+        -------
+        encoded_states : the state path of every recording, also set as its encoded_state.
+        """
+        groups = {}
+        for mono in monos:
+            groups.setdefault((mono.hmm, mono.float_dtype), []).append(mono)
+        for (hmm, _), group in groups.items():
+            for mono, states in zip(group, hmm.viterbi_batch([mono.priors for mono in group])):
+                mono.encoded_state = states
+        return [mono.encoded_state for mono in monos]
 
 
     def simple_notation(self, result ):
@@ -285,17 +719,193 @@ class Mono(MonoParams):
 
         Parameters
         ----------
-        result : np.array of note as string format e.g. 'C4', 'N'
+        result : np.array of note as string format e.g. 'C4', 'N',
+            or np.array of HMM states (see encoded_state), only the notes of the changes are named
 
         Returns
         -------
         simple_notation : list of tuple (note: string, onset_time: float, note_duration: float)
         """
-
-        change_index = np.insert(np.where(result[1:] != result[:-1])[0] + 1, 0, 0)
+        result = np.asarray(result)
+        # the onset and the sustain of a note are the same note
+        notes = (result + 1) // 2 if np.issubdtype(result.dtype, np.integer) else result
+        change_index = np.insert(np.where(notes[1:] != notes[:-1])[0] + 1, 0, 0)
         onset_time = change_index * self.hop_time
         duration = np.append(onset_time[1:], len(result) * self.hop_time) - onset_time
-        return list(zip(result[change_index], onset_time, duration))
+        names = self.state_names[result[change_index]] if notes is not result else result[change_index]
+        return list(zip(names, onset_time, duration))
+
+
+class StreamingMono(MonoParams):
+    """
+    Mono transcribing a signal block by block, while it is played or decoded.
+
+    The pitch, voicing and onset priors of the new frames are estimated as in Mono, on a window with context_duration
+    of signal on each side of the frames. The note states are decoded online with a fixed-lag Viterbi: a frame is
+    decided from the best path once lag seconds of frames after it are decoded, so a note is emitted at most
+    block_duration + context_duration + lag seconds after it ends.
+    ----------
+    Methods:
+        push(block) -> return : list of the notes finalised by the block
+        flush() -> return : list of the last notes once the signal is over
+        transcribe(blocks) -> return : generator of the notes of the signal
+    The notes are (note, onset_time, note_duration) tuples, as in Mono.simple_notation.
+    ----------
+    attributes:
+        tuning -> return : float, tuning of the pitches so far, as librosa.pitch_tuning of all of them
+    """
+    # edges of the histogram of the deviations of the pitches from the equal temperament, as in librosa.pitch_tuning
+    tuning_bins = np.linspace(-0.5, 0.5, 101)
+
+    def __init__(self, lag: float = 1.0, block_duration: float = 1.0, context_duration: float = 0.5):
+        """
+        Parameters
+        ----------
+        lag : float
+            Seconds of decoded frames after a frame before it is decided.
+        block_duration : float
+            Seconds of new frames analysed at once, shorter blocks lower the latency but analyse the context more often.
+        context_duration : float
+            Seconds of signal on each side of the frames analysed, it covers the harmonic/percussive separation,
+            the pyin frames and the onset peak picking.
+        """
+        super(StreamingMono, self).__init__()
+        # the precision is fixed when the estimator is created, as for AudioSignal
+        self.precision = self.precision
+        self.lag_frames = int(round(lag / self.hop_time))
+        self.block_frames = max(1, int(round(block_duration / self.hop_time)))
+        self.context_frames = int(np.ceil(context_duration / self.hop_time))
+        # samples [offset, offset + len(buffer)) of the signal
+        self.buffer, self.offset = np.zeros(0, dtype=np.float32), 0
+        self.n_samples = 0
+        # frames [0, n_analysed) have their priors decoded, frames [0, n_decided) have their state decided
+        self.n_analysed, self.n_decided = 0, 0
+        # the histogram is updated with the pitches of every block, the pitches themselves are not kept
+        self.tuning_counts = np.zeros(len(self.tuning_bins) - 1, dtype=int)
+        # range of the onset strength so far, it replaces the normalisation of the whole envelope by onset_detect
+        self.onset_min, self.onset_max = np.inf, -np.inf
+        # Viterbi log probabilities at the last analysed frame and predecessors of the undecided frames
+        self.value, self.ptr = None, np.zeros((0, self.hmm.n_states), dtype=int)
+        # note being played at the end of the decided frames, (state + 1) // 2, and its first frame
+        self.note, self.note_start = None, 0
+
+    @property
+    def tuning(self) -> float:
+        if not self.tuning_counts.any():
+            return 0.0
+        return self.tuning_bins[np.argmax(self.tuning_counts)]
+
+    def add_pitches(self, f0: np.ndarray):
+        """
+        Add the pitches of new frames to the tuning histogram, the unvoiced frames (nan pitch) are ignored.
+        """
+        f0 = f0[f0 > 0]
+        residual = np.mod(12 * librosa.hz_to_octs(f0), 1.0)
+        residual[residual >= 0.5] -= 1.0
+        self.tuning_counts += np.histogram(residual, self.tuning_bins)[0]
+
+    def push(self, block: np.ndarray) -> list[tuple]:
+        """
+        Add the next samples of the signal, at sampling_rate, and return the notes finalised since the last call.
+        """
+        self.buffer = np.concatenate((self.buffer, np.asarray(block, dtype=np.float32)))
+        self.n_samples += len(block)
+        # frames with context_frames of signal after them
+        ready = self.n_samples // self.hop_length - self.context_frames
+        if ready - self.n_analysed < self.block_frames:
+            return []
+        self.analyse(ready)
+        return self.decide(self.n_analysed - self.lag_frames)
+
+    def flush(self) -> list[tuple]:
+        """
+        Analyse the end of the signal and return its notes, the last one included.
+        """
+        n_frames = 1 + self.n_samples // self.hop_length
+        if self.n_samples == 0:
+            return []
+        if self.n_analysed < n_frames:
+            self.analyse(n_frames, last=True)
+        notes = self.decide(n_frames)
+        notes.append(self.finish_note(n_frames))
+        return notes
+
+    def transcribe(self, blocks):
+        """
+        Yields the notes of the signal given block by block, as soon as they are finalised.
+        """
+        for block in blocks:
+            yield from self.push(block)
+        yield from self.flush()
+
+    def analyse(self, stop: int, last: bool = False):
+        """
+        Compute the priors of the frames [n_analysed, stop) and run the Viterbi recursion over them.
+        The window analysed ends context_frames after stop, or at the end of the signal if it is the last one.
+        """
+        start = self.n_analysed
+        first = max(start - self.context_frames, 0)
+        end = self.n_samples if last else (stop + self.context_frames) * self.hop_length
+        window = self.buffer[first * self.hop_length - self.offset:end - self.offset]
+        frames = slice(start - first, stop - first)
+
+        harmonic, percussive = librosa.effects.hpss(window)
+        factor = self.decimation()
+        if factor > 1:
+            harmonic = resample_poly(harmonic, 1, factor).astype(harmonic.dtype, copy=False)
+        f0, voiced_flag, voiced_prob = self.pitch_track(harmonic, factor)[:, frames]
+        self.add_pitches(f0)
+
+        envelope = librosa.onset.onset_strength(y=percussive, sr=self.sampling_rate, hop_length=self.hop_length)
+        self.onset_min = min(self.onset_min, np.min(envelope))
+        self.onset_max = max(self.onset_max, np.max(envelope))
+        envelope = (envelope - self.onset_min) / (self.onset_max - self.onset_min + np.finfo(envelope.dtype).tiny)
+        try:
+            onsets = librosa.onset.onset_detect(onset_envelope=envelope, sr=self.sampling_rate,
+                                                hop_length=self.hop_length, backtrack=True, normalize=False)
+        except librosa.util.exceptions.ParameterError:
+            # a window without any local minimum of the onset strength to backtrack the onsets to
+            onsets = librosa.onset.onset_detect(onset_envelope=envelope, sr=self.sampling_rate,
+                                                hop_length=self.hop_length, normalize=False)
+        onset_flags = np.zeros(len(envelope), dtype=bool)
+        onset_flags[onsets] = True
+
+        priors = self.build_priors(f0.astype(self.float_dtype), voiced_flag.astype(bool),
+                                   voiced_prob.astype(self.float_dtype), onset_flags[frames], self.tuning)
+        value, ptr = self.hmm.forward(np.log(priors.T + np.finfo(priors.dtype).tiny), self.value)
+        # the offset does not change the best path, it keeps the log probabilities in range on long signals
+        self.value = value - np.max(value)
+        self.ptr = np.concatenate((self.ptr, ptr))
+        self.n_analysed = stop
+
+        # only the context of the next window is kept
+        keep = max(self.n_analysed - self.context_frames, 0) * self.hop_length
+        self.buffer, self.offset = self.buffer[keep - self.offset:], keep
+
+    def decide(self, stop: int) -> list[tuple]:
+        """
+        Decide the states of the frames [n_decided, stop) from the best path at the last analysed frame
+        and return the notes they end.
+        """
+        if stop <= self.n_decided:
+            return []
+        states = self.hmm.backtrack(self.ptr, np.argmax(self.value))[:stop - self.n_decided]
+        self.ptr = self.ptr[stop - self.n_decided:]
+        # the onset and the sustain of a note are the same note
+        keys = (states + 1) // 2
+        changes = np.flatnonzero(np.diff(keys, prepend=-1 if self.note is None else self.note))
+        notes = []
+        for change in changes:
+            if self.note is not None:
+                notes.append(self.finish_note(self.n_decided + change))
+            self.note, self.note_start = keys[change], self.n_decided + change
+        self.n_decided = stop
+        return notes
+
+    def finish_note(self, stop: int) -> tuple:
+        # the state 2 * key is the silence or the sustain of the note
+        return (self.state_names[2 * self.note], self.note_start * self.hop_time,
+                (stop - self.note_start) * self.hop_time)
 
 
 if __name__ == "__main__":
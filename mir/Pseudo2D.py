@@ -5,84 +5,196 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 # from Test.generate_sample_for_test import MusicGenerator
-from mir.MusicRetrieval import AudioSignal, AudioParams, Note
+from mir.MusicRetrieval import AudioSignal, AudioStream, AudioParams, Note
 from functools import cached_property
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import shared_memory
 import matplotlib.pyplot as plt
 
 # import pdb; pdb.set_trace()
 
 class Pseudo2D(AudioParams):
+    engines = ("fft", "rank1", "sparse")
+    front_ends = ("cqt", "logstft")
+    # stages of the estimation kept between calls, a stage is computed again only when one of its inputs changes
+    # and every later stage is computed again when an earlier one changes, see staged
+    pipeline = ("cqt", "cross_correlation", "raw_piano_roll")
+
     def __init__(self, audio: AudioSignal) -> None:
         super().__init__()
+        if audio is not None:
+            self.precision = audio.precision
         self.n_bins_per_octave = 36
         self.n_harmonics = 3
+        # spectrum the pseudo 2D frames are built from, see compute_spectrum
+        self.front_end = "cqt"
+        # fft size of the logstft front-end
+        self.n_fft = 4096
         self.audio = audio
         self.threshold = 0.54
         self.std_threshold = 1e-3
         self.gamma = 1
         self.min_length = 4
+        # template set by the user, the harmonic comb is used if None
+        self.custom_template = None
+        self.stages = {}
 
-    @cached_property
+    def staged(self, stage: str, inputs, compute):
+        """
+        Result of compute() for a stage of the pipeline, computed again only if inputs changed since the last call.
+
+        Parameters:
+            stage: name of the stage, ex: 'cross_correlation'.
+            inputs: every parameter the stage depends on, compared with == to the inputs of the stored result.
+            compute: callable returning the result of the stage.
+        """
+        stored = self.stages.get(stage)
+        if stored is not None and stored[0] == inputs:
+            return stored[1]
+        result = compute()
+        self.store(stage, inputs, result)
+        return result
+
+    def store(self, stage: str, inputs, result):
+        """
+        Keep result as the output of stage for inputs, the later stages of the pipeline are dropped.
+        """
+        if stage in self.pipeline:
+            for later in self.pipeline[self.pipeline.index(stage):]:
+                self.stages.pop(later, None)
+        self.stages[stage] = (inputs, result)
+
+    @property
+    def cqt_params(self) -> dict:
+        """
+        Every parameter the spectrum of the front-end depends on.
+        """
+        params = {"source": "y_harmonic", "sampling_rate": self.sampling_rate, "hop_length": self.hop_length,
+                  "note_min": self.note_min.string, "note_max": self.note_max.string,
+                  "n_bins_per_octave": self.n_bins_per_octave, "window": "hann", "dtype": self.complex_dtype}
+        if self.front_end == "logstft":
+            params.update(front_end=self.front_end, n_fft=self.n_fft, dtype=self.float_dtype)
+        return params
+
+    @property
     def cqt(self):
         """
-        Compute the constant-Q transform (CQT) of the harmonic audio signal.
+        Compute the spectrum of the harmonic audio signal with the front-end, the constant-Q transform (CQT) by default.
+        The spectrum is kept in the feature store of the audio, the estimators of the same recording share it.
         Returns:
-        - cqt: Constant-Q transform of the harmonic audio signal.
+        - cqt: np.ndarray(N, M): spectrum of the harmonic audio signal, one column per frame.
+        """
+        params = self.cqt_params
+        return self.staged("cqt", params, lambda: self.audio.features.get(
+            self.front_end, params, lambda: self.compute_spectrum(self.audio.y_harmonic)))
+
+    @cqt.setter
+    def cqt(self, cqt: np.ndarray):
+        self.store("cqt", self.cqt_params, cqt)
+
+    @cqt.deleter
+    def cqt(self):
+        for stage in self.pipeline:
+            self.stages.pop(stage, None)
+
+    @property
+    def n_bins(self) -> int:
+        return self.n_notes * (self.n_bins_per_octave // 12)
+
+    def compute_spectrum(self, y: np.ndarray) -> np.ndarray:
+        """
+        Spectrum of y computed by the front-end: compute_cqt for 'cqt', logstft for 'logstft'.
+
+        Raises:
+            ValueError: if the front-end is unknown.
         """
-        cqt = librosa.cqt(y=self.audio.y_harmonic,
+        if self.front_end == "cqt":
+            return self.compute_cqt(y)
+        elif self.front_end == "logstft":
+            return self.logstft(y)
+        raise ValueError(f"Unknown front-end: {self.front_end}, please use one of {self.front_ends}")
+
+    def compute_cqt(self, y: np.ndarray) -> np.ndarray:
+        """
+        Constant-Q transform of y with the resolution expected by the pseudo 2D spectrum.
+        """
+        cqt = librosa.cqt(y=y,
                           sr=self.sampling_rate, fmin=self.note_min.hz,
                           hop_length=self.hop_length,
-                          n_bins=((self.note_max.midi - self.note_min.midi + 1)
-                                  * (self.n_bins_per_octave // 12)),
+                          n_bins=self.n_bins,
                           bins_per_octave=self.n_bins_per_octave,
-                          window='hann'
+                          window='hann',
+                          dtype=self.complex_dtype
                           )
         return cqt
 
-    def logstft(self):
+    def logstft(self, y: np.ndarray) -> np.ndarray:
         """
-        Compute the short-time Fourier transform (STFT) of the harmonic audio signal and bin the output in log scale.
+        Magnitude of the short-time Fourier transform (STFT) of y binned on the frequencies of compute_cqt.
 
-        Its not currently used but may be of use later on in the project
+        The frames are aligned with the frames of compute_cqt, the binning is a single sparse product,
+        see pitch_binning.
 
         Returns:
-        - Logstft: Log Short-time Fourier transform of the harmonic audio signal.
-        """
-        X_stft = librosa.stft(
-            y=self.audio.y_harmonic,
-            hop_length=self.hop_length)
-        # bin the note from the stft
-        # Convert frequency bins to MIDI note numbers
-        ax_freq_lin = librosa.fft_frequencies(sr=self.sampling_rate)
-        ax_freq_lin = np.arange(
-            X_stft.shape[0]) * self.sampling_rate / self.window_length
-        pitches = np.arange(self.note_min.midi, self.note_max.midi + 1)
-        ax_freq_log = librosa.midi_to_hz(pitches)
-
-        frequencies = librosa.fft_frequencies(
-            sr=self.sampling_rate, n_fft=X_stft.shape[0])
-
-        def center_freq(p, A4_tuning=440.0):
-            return A4_tuning * 2**((p - 69) / 12)
-
-        X_stft_log = np.zeros((len(pitches), X_stft.shape[1]))
-
-        for cur_pitch in pitches:
-            f_lower_bound = center_freq(cur_pitch - 0.5)
-            f_upper_bound = center_freq(cur_pitch + 0.5)
-
-            cur_idxs = np.where(
-                (ax_freq_lin >= f_lower_bound) & (
-                    ax_freq_lin < f_upper_bound))
-            X_stft_log[cur_pitch - pitches[0]
-                       ] = np.sum(np.abs(X_stft[cur_idxs]), axis=0)
-        return X_stft_log
+            np.ndarray(N, M): log-frequency magnitude spectrum, one column per frame.
+        """
+        stft = librosa.stft(y=y, n_fft=self.n_fft, hop_length=self.hop_length, window='hann', dtype=self.complex_dtype)
+        pitch_binning = self.pitch_binning
+        # the STFT bins above the highest note are not used
+        used = pitch_binning.indices.max(initial=-1) + 1
+        return pitch_binning[:, :used] @ np.abs(stft[:used])
+
+    @property
+    def pitch_binning(self) -> scipy.sparse.csr_matrix:
+        """
+        Sparse (N, n_fft // 2 + 1) matrix summing the STFT bins into the N bins of compute_cqt.
+
+        Each bin is a triangular filter centered on its frequency and spanning its neighbours, or the
+        neighbouring STFT bins where they are further apart: the high bins sum the STFT bins of their band and
+        the low bins, narrower than the STFT resolution, interpolate between the two closest STFT bins.
+        The filters are scaled so a sinusoid has the same magnitude as in compute_cqt, the gamma and std_threshold
+        tuned for the cqt front-end keep the same meaning.
+        """
+        def compute():
+            centers = librosa.cqt_frequencies(self.n_bins, fmin=self.note_min.hz,
+                                              bins_per_octave=self.n_bins_per_octave)
+            frequencies = librosa.fft_frequencies(sr=self.sampling_rate, n_fft=self.n_fft)
+            widths = np.maximum(centers * (2**(1 / self.n_bins_per_octave) - 1), frequencies[1])
+            first = np.searchsorted(frequencies, centers - widths, side="right")
+            last = np.searchsorted(frequencies, centers + widths, side="left")
+            rows = np.repeat(np.arange(self.n_bins), last - first)
+            cols = np.concatenate([np.arange(a, b) for a, b in zip(first, last)])
+            weights = 1 - np.abs(frequencies[cols] - centers[rows]) / widths[rows]
+            # a sinusoid of amplitude a peaks at a * n_fft / 4 in the hann STFT, with a * n_fft / 8 on the two
+            # neighbouring STFT bins which are weighted by 1 - df / width, and at a * sqrt(length) / 2 in the cqt
+            lengths, _ = librosa.filters.wavelet_lengths(freqs=centers, sr=self.sampling_rate, window='hann')
+            gain = (2 - frequencies[1] / widths) * self.n_fft / 4
+            weights *= (np.sqrt(lengths) / 2 / gain)[rows]
+            return scipy.sparse.csr_matrix((weights.astype(self.float_dtype), (rows, cols)),
+                                           shape=(self.n_bins, len(frequencies)))
+
+        inputs = (self.sampling_rate, self.n_fft, self.n_bins_per_octave, self.note_min.string,
+                  self.note_max.string, self.precision)
+        return self.staged("pitch_binning", inputs, compute)
 
     def R(self, x):
         return self.n_bins_per_octave * np.log2(np.ceil(x))
 
-    @cached_property
+    @property
     def template_matrix(self):
+        """
+        Template matrix used for multi-pitch estimation, the harmonic comb unless another template was set.
+        """
+        if self.custom_template is not None:
+            return self.custom_template
+        return self.staged("template_matrix", (self.n_harmonics, self.n_bins_per_octave), self.harmonic_comb)
+
+    @template_matrix.setter
+    def template_matrix(self, template_matrix: np.ndarray):
+        self.custom_template = template_matrix
+
+    def harmonic_comb(self):
         """
         Create a sparse 2-D template matrix for multi-pitch estimation.
         Returns:
@@ -113,8 +225,6 @@ class Pseudo2D(AudioParams):
                           bins_per_octave=self.n_bins_per_octave,
                           window='hann',
                           )
-        # detect onset
-        onset = librosa.onset.onset_detect(y=audio.y, sr=audio.sampling_rate)
         # Detect the fundamental frequency using pyin
         f0, voiced_flag, voiced_probs = librosa.pyin(audio.y, fmin=self.note_min.hz, fmax=self.note_max.hz, sr=audio.sampling_rate)
         frame = np.argmax(voiced_probs)
@@ -140,13 +250,45 @@ class Pseudo2D(AudioParams):
         template_1D /= np.linalg.norm(template_1D)
         return np.abs(np.outer(template_1D.conj(), template_1D))
 
+    @property
+    def harmonic_profile(self):
+        """
+        1-D factor r of the template matrix, such that template_matrix == outer(r, r).
+
+        Both the synthetic harmonic comb and the templates learned from audio are
+        outer products of a non-negative vector with itself, so r is recovered from the diagonal.
+
+        Raises:
+            ValueError: if the template matrix is not a rank-1 outer product.
+        """
+        return rank1_profile(self.template_matrix)
+
     @property
     def pseudo_2d(self):
 
-        res = (np.outer(self.cqt[:, i], self.cqt[:, i].conj())
-            for i in range(self.cqt.shape[1]))
+        res = (self.frame(i) for i in range(self.cqt.shape[1]))
         return res
 
+    def frame(self, index: int) -> np.ndarray:
+        """
+        Pseudo 2D spectrum of a single frame, the other frames are not computed.
+
+        Raises:
+            IndexError: if the frame is out of bounds.
+        """
+        n_frames = self.cqt.shape[1]
+        if not -n_frames <= index < n_frames:
+            raise IndexError(f"Frame {index} is out of bounds with the {n_frames} frames of the audio")
+        column = self.cqt[:, index]
+        return np.outer(column, column.conj())
+
+    def frames_between(self, start: float, stop: float):
+        """
+        Generator of the pseudo 2D spectrum of the frames between start and stop (in seconds).
+        """
+        first, last = librosa.time_to_frames([start, stop], sr=self.sampling_rate, hop_length=self.hop_length)
+        return (self.frame(i) for i in range(max(first, 0), min(last, self.cqt.shape[1])))
+
     def cross_correlate_diag(self, pseudo2dSpectrum, _2D=True):
         """
         Cross-correlate the pseudo2dSpectrum with the template matrix
@@ -165,22 +307,183 @@ class Pseudo2D(AudioParams):
         # normalize spectrum
         pseudo2dSpectrum /= np.sqrt(np.sum(pseudo2dSpectrum))
         if std < self.std_threshold:
-            return np.zeros(pseudo2dSpectrum.diagonal().shape)
+            return np.zeros(pseudo2dSpectrum.diagonal().shape, dtype=self.float_dtype)
+        template_matrix = self.template_matrix.astype(self.float_dtype)
         if not _2D:
             conv = scipy.signal.correlate(
                 pseudo2dSpectrum.diagonal(),
-                self.template_matrix.diagonal(),
+                template_matrix.diagonal(),
                 mode="same",
                 method="fft")
         else:
             conv = np.diag(
                 scipy.signal.correlate(
                     pseudo2dSpectrum,
-                    self.template_matrix,
+                    template_matrix,
                     mode="same",
                     method="fft"))
         return conv
 
+    def cross_correlate_rank1(self, cqt: np.ndarray, frames_per_chunk: int = 128) -> np.ndarray:
+        """
+        Same result as cross_correlate_diag(frame, _2D=True) for every column of the cqt at once,
+        without building the pseudo 2D spectrum nor running a 2-D FFT correlation.
+
+        Each frame is the outer product c c^H of one cqt column and the template is the outer product r r^T,
+        so the standard deviation of the frame has a closed form and only the entries of the frame
+        facing a non-zero tap of the template are needed to get the diagonal of the correlation.
+
+        Parameters:
+            cqt: np.ndarray(N, M): complex cqt, one column per frame.
+            frames_per_chunk: number of frames processed together, bounds the memory used.
+
+        Returns:
+            np.ndarray(N, M): the cross-correlation of every frame with the template matrix.
+        """
+        return self.cross_correlate_profiles(cqt, self.harmonic_profile[None, :], frames_per_chunk)[0]
+
+    def cross_correlate_profiles(self, cqt: np.ndarray, profiles: np.ndarray, frames_per_chunk: int = 128) -> np.ndarray:
+        """
+        cross_correlate_rank1 against several rank-1 templates outer(r, r) in one pass.
+
+        The std gate, the normalization and the log-compressed entries of the frames are computed once
+        for the union of the taps of every template, only the weighting differs between templates.
+
+        Parameters:
+            cqt: np.ndarray(N, M): complex cqt, one column per frame.
+            profiles: np.ndarray(T, L): one 1-D factor r per template, see rank1_profile.
+
+        Returns:
+            np.ndarray(T, N, M): the cross-correlation of every frame with every template.
+        """
+        offsets, weights = merge_taps([template_taps(np.outer(profile, profile)) for profile in profiles])
+        return self.cross_correlate_taps(cqt, offsets, weights, frames_per_chunk=frames_per_chunk)
+
+    def cross_correlate_sparse(self, cqt: np.ndarray, normalize: bool = True, frames_per_chunk: int = 128) -> np.ndarray:
+        """
+        Same result as cross_correlate_diag(frame, _2D=True) for every column of the cqt at once,
+        for any template matrix, see template_taps.
+
+        The cost grows with the number of non-zero entries of the template (n_harmonics^2 for the harmonic comb)
+        instead of its size, except for the normalization which needs every entry of the frame.
+
+        Parameters:
+            cqt: np.ndarray(N, M): complex cqt, one column per frame.
+            normalize: divide by the norm of the log-compressed frame like cross_correlate_diag.
+                The peaks found by peak_picking do not depend on this scale so it can be skipped.
+
+        Returns:
+            np.ndarray(N, M): the cross-correlation of every frame with the template matrix.
+        """
+        offsets, weights = template_taps(self.template_matrix)
+        return self.cross_correlate_taps(cqt, offsets, weights[None, :], normalize, frames_per_chunk)[0]
+
+    def cross_correlate_taps(self, cqt: np.ndarray, offsets: np.ndarray, weights: np.ndarray,
+                             normalize: bool = True, frames_per_chunk: int = 128) -> np.ndarray:
+        """
+        Diagonal of the correlation of every frame c c^H with templates given as sparse taps,
+        out[k] = sum over the taps of weight * log(1 + gamma |c[k + i] c[k + j]^* + eps|).
+
+        Parameters:
+            cqt: np.ndarray(N, M): complex cqt, one column per frame.
+            offsets: np.ndarray(K, 2) of int: (i, j) offsets of the taps with respect to the diagonal.
+            weights: np.ndarray(T, K): weight of every tap for each of the T templates.
+            normalize: divide by the norm of the log-compressed frame like cross_correlate_diag.
+            frames_per_chunk: number of frames processed together, bounds the memory used.
+
+        Returns:
+            np.ndarray(T, N, M): the cross-correlation of every frame with every template.
+        """
+        n_bins, n_frames = cqt.shape
+        reach = int(np.max(np.abs(offsets), initial=0))
+        eps = np.finfo(np.float32).eps
+
+        weights = weights.astype(self.float_dtype)
+        # std of c c^H: mean|P|^2 = (sum|c|^2)^2 / N^2 and |mean P|^2 = |sum c|^4 / N^4
+        # kept in double precision, the difference of squares cancels out on quiet frames
+        power = np.sum(np.abs(cqt)**2, axis=0, dtype=np.float64)
+        total = np.abs(np.sum(cqt, axis=0, dtype=np.complex128))**2
+        std = np.sqrt(np.maximum((n_bins * power)**2 - total**2, 0)) / n_bins**2
+
+        # |c_i c_j^* + eps| == |c_j c_i^* + eps| so the normalization only needs the upper triangle
+        upper_i, upper_j = np.triu_indices(n_bins, k=1)
+        # the frame is zero padded by the correlation, not its log-compressed value
+        padded = np.zeros((n_bins + 2 * reach, n_frames), dtype=cqt.dtype)
+        padded[reach:reach + n_bins] = cqt
+        inside = np.zeros(n_bins + 2 * reach, dtype=bool)
+        inside[reach:reach + n_bins] = True
+
+        conv = np.zeros((weights.shape[0], n_bins, n_frames), dtype=self.float_dtype)
+        for start in range(0, n_frames, frames_per_chunk):
+            chunk = slice(start, min(start + frames_per_chunk, n_frames))
+
+            for (i, j), tap_weights in zip(offsets, weights.T):
+                rows_i = slice(reach + i, reach + i + n_bins)
+                rows_j = slice(reach + j, reach + j + n_bins)
+                valid = inside[rows_i] & inside[rows_j]
+                compressed = np.log(1 + self.gamma * np.abs(
+                    padded[rows_i, chunk] * padded[rows_j, chunk].conj() + eps)) * valid[:, None]
+                conv[:, :, chunk] += tap_weights[:, None, None] * compressed
+
+            if normalize:
+                c = cqt[:, chunk]
+                diag = np.log(1 + self.gamma * np.abs(np.abs(c)**2 + eps))
+                off_diag = np.log(1 + self.gamma * np.abs(c[upper_i] * c[upper_j].conj() + eps))
+                norm = np.sqrt(np.sum(diag, axis=0) + 2 * np.sum(off_diag, axis=0))
+                conv[:, :, chunk] /= norm.astype(self.float_dtype)
+        conv[:, :, std < self.std_threshold] = 0
+        return conv
+
+    def match_templates(self, templates: dict) -> dict:
+        """
+        Cross-correlate every frame with several templates at once, ex: a piano, a guitar and the synthetic comb.
+
+        Parameters:
+            templates: {name: template matrix}, every template must be a rank-1 outer product of the same size.
+
+        Returns:
+            {name: np.ndarray(N, M)}: the cross-correlation of every frame with each template.
+        """
+        profiles = [rank1_profile(template) for template in templates.values()]
+        if len({profile.shape for profile in profiles}) > 1:
+            raise ValueError("Every template must have the same size to be matched together")
+        conv = self.cross_correlate_profiles(self.cqt, np.stack(profiles))
+        return dict(zip(templates, conv))
+
+    def cross_correlation(self, engine: str = "fft", normalize: bool = True) -> np.ndarray:
+        """
+        Cross-correlate every frame of the pseudo 2D spectrum with the template matrix.
+
+        Parameters:
+            engine: "fft" runs cross_correlate_diag on each frame, "rank1" uses cross_correlate_rank1
+                and "sparse" cross_correlate_sparse on the whole cqt.
+            normalize: only the sparse engine can skip the normalization of the frames, see cross_correlate_sparse.
+
+        Returns:
+            np.ndarray(N, M): one column of cross-correlation per frame.
+        """
+        if engine not in self.engines:
+            raise ValueError(f"Unknown engine: {engine}, please use one of {self.engines}")
+        # the cqt is brought up to date first, a new cqt drops the stored cross-correlation
+        cqt = self.cqt
+
+        def compute():
+            if engine == "fft":
+                return np.stack([self.cross_correlate_diag(frame, _2D=True) for frame in self.pseudo_2d], axis=1)
+            elif engine == "rank1":
+                return self.cross_correlate_rank1(cqt)
+            return self.cross_correlate_sparse(cqt, normalize)
+
+        return self.staged("cross_correlation", self.correlation_inputs(engine, normalize), compute)
+
+    def correlation_inputs(self, engine: str, normalize: bool = True) -> tuple:
+        """
+        Every parameter the cross-correlation depends on besides the cqt.
+        """
+        template_matrix = self.template_matrix
+        return (engine, normalize, self.gamma, self.std_threshold,
+                template_matrix.shape, template_matrix.tobytes())
+
     def best_estimate(self, cross_corr: np.ndarray) -> np.ndarray:
         """
         Gives best estimate of the pitch by returning the
@@ -207,43 +510,144 @@ class Pseudo2D(AudioParams):
         return (indexs.flatten() -
                 self.template_matrix.shape[0] // 2) // bin_per_note
 
-    def filter_short_notes(self, piano_roll: np.ndarray):
+    def peak_picking(self, cross_corr: np.ndarray) -> np.ndarray:
+        """
+        best_estimate of every frame in one pass, the notes are directly folded into a piano roll.
+
+        Parameters:
+            cross_corr: np.ndarray(N, M): the cross correlation of every frame, see cross_correlation.
+
+        Returns:
+            piano_roll: np.ndarray(n_notes, M) of bool, True where a note is estimated.
+        """
+        span = np.max(cross_corr, axis=0) - np.min(cross_corr, axis=0)
+        bin_per_note = self.n_bins_per_octave // 12
+
+        bins, frames = np.nonzero(
+            (cross_corr > self.threshold * span)
+            & (cross_corr > np.roll(cross_corr, 1, axis=0))
+            & (cross_corr > np.roll(cross_corr, -1, axis=0))
+        )
+
+        piano_roll = np.zeros((self.n_notes, cross_corr.shape[1]), dtype=bool)
+        piano_roll[(bins - self.template_matrix.shape[0] // 2) // bin_per_note, frames] = True
+        return piano_roll
+
+    def note_runs(self, piano_roll: np.ndarray) -> np.ndarray:
+        """
+        Run-length encoding of the piano roll.
+
+        Returns:
+            runs: np.ndarray(R, 3) of int, one row (pitch, onset frame, offset frame) per note,
+                the offset frame is the first frame after the note, rows are sorted by pitch then onset.
+        """
+        padded = np.zeros((piano_roll.shape[0], piano_roll.shape[1] + 2), dtype=np.int8)
+        padded[:, 1:-1] = piano_roll > 0
+        edges = np.diff(padded, axis=1)
+        pitches, onsets = np.nonzero(edges == 1)
+        _, offsets = np.nonzero(edges == -1)
+        return np.column_stack((pitches, onsets, offsets))
+
+    def filter_short_notes(self, piano_roll: np.ndarray, return_runs: bool = False):
         """
         Filter out notes that are shorter than the specified minimum length.
+
+        Parameters:
+            piano_roll: np.ndarray(n_notes, M), modified in place.
+            return_runs: also return the run table of the remaining notes, see note_runs.
+
+        Returns:
+            piano_roll or (piano_roll, runs)
         """
-        for note in range(piano_roll.shape[0]):
-            note_onsets = np.where(np.diff(np.concatenate(
-                ([0], piano_roll[note, :], [0]))) == 1)[0]
-            note_offsets = np.where(np.diff(np.concatenate(
-                ([0], piano_roll[note, :], [0]))) == -1)[0]
-            length = len(note_onsets)
-            for i in range(length):
-                if note_offsets[i] - note_onsets[i] < self.min_length:
-                    piano_roll[note, note_onsets[i]:note_offsets[i]] = 0
+        runs = self.note_runs(piano_roll)
+        short = runs[:, 2] - runs[:, 1] < self.min_length
 
+        # +1 at the onset and -1 at the offset of every short note, the cumulative sum covers their frames
+        delta = np.zeros((piano_roll.shape[0], piano_roll.shape[1] + 1), dtype=int)
+        np.add.at(delta, (runs[short, 0], runs[short, 1]), 1)
+        np.add.at(delta, (runs[short, 0], runs[short, 2]), -1)
+        piano_roll[np.cumsum(delta, axis=1)[:, :-1] > 0] = 0
 
+        if return_runs:
+            return piano_roll, runs[~short]
         return piano_roll
 
-    def multipitch_estimate(self):
+    def raw_piano_roll(self, engine: str = "fft", jobs: int = 1) -> np.ndarray:
+        """
+        Piano roll of the best estimate of every frame, before filtering out the short notes.
+
+        The piano roll is kept until the cqt, the cross-correlation parameters or the threshold change,
+        the cross-correlation is kept until the cqt or its own parameters change, so a sweep over
+        the threshold only runs peak_picking again.
+
+        Parameters:
+            engine: correlation engine, see cross_correlation.
+            jobs: number of processes used to go through the frames, see parallel_raw_piano_roll.
+        Returns:
+            piano_roll: np.ndarray of shape (n_notes, n_frames), shared with the next calls, do not modify it.
+        """
+        # the cqt is brought up to date first, a new cqt drops the stored piano roll
+        self.cqt
+        # peak_picking only depends on the relative values of a frame, the normalization is not needed
+        inputs = (self.correlation_inputs(engine, normalize=False), self.threshold)
+
+        def compute():
+            # the workers compute the cross-correlation again, unless it is already stored
+            stored = self.stages.get("cross_correlation")
+            if jobs > 1 and (stored is None or stored[0] != self.correlation_inputs(engine, normalize=False)):
+                return self.parallel_raw_piano_roll(engine, jobs)
+            return self.peak_picking(self.cross_correlation(engine, normalize=False)).astype(self.float_dtype)
+
+        return self.staged("raw_piano_roll", inputs, compute)
+
+    def parallel_raw_piano_roll(self, engine: str = "fft", jobs: int = 2, blocks_per_job: int = 4) -> np.ndarray:
+        """
+        Same result as raw_piano_roll, the frames are split in blocks processed by a pool of jobs processes.
+        The cqt is shared with the workers through shared memory instead of being pickled, the workers send back
+        their cross-correlation so it is stored as with raw_piano_roll and a change of threshold or min_length
+        does not compute it again.
+
+        Starting the processes and sending the blocks back adds about 0.1 s per job, while the fft engine takes
+        about 2 s per minute of audio in one process: the pool only pays off with several cores on recordings of
+        several minutes with the fft engine. The rank1 and sparse engines are fast enough in a single process.
+        """
+        cqt = self.cqt
+        # everything but the audio and the cqt is needed to rebuild the estimator in the workers
+        settings = {key: value for key, value in vars(self).items() if key not in ("audio", "stages")}
+        settings["custom_template"] = self.template_matrix
+        settings["precision"] = self.precision
+        bounds = np.unique(np.linspace(0, cqt.shape[1], jobs * blocks_per_job + 1).astype(int))
+
+        shm = shared_memory.SharedMemory(create=True, size=max(cqt.nbytes, 1))
+        try:
+            shared_cqt = np.ndarray(cqt.shape, dtype=cqt.dtype, buffer=shm.buf)
+            shared_cqt[:] = cqt
+            del shared_cqt
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                blocks = list(pool.map(_raw_piano_roll_block, repeat(shm.name), repeat(cqt.shape), repeat(cqt.dtype),
+                                       bounds[:-1], bounds[1:], repeat(settings), repeat(engine)))
+        finally:
+            shm.close()
+            shm.unlink()
+        cross_correlations, piano_rolls = zip(*blocks)
+        self.store("cross_correlation", self.correlation_inputs(engine, normalize=False),
+                   np.concatenate(cross_correlations, axis=1))
+        return np.concatenate(piano_rolls, axis=1)
+
+    def multipitch_estimate(self, engine: str = "fft", jobs: int = 1):
         """
         Estimate the multipitch of the audio signal.
+        Parameters:
+            engine: correlation engine, see cross_correlation.
+            jobs: number of processes used to go through the frames, see parallel_raw_piano_roll.
         Returns: (song, piano_roll)
             song: list of np.array of frequencies in hz
             piano_roll: np.ndarray of shape (n_notes, n_frames)
 
         """
-        song = [
-            self.best_estimate(
-                self.cross_correlate_diag(
-                    frame,
-                    _2D=True)) for frame in self.pseudo_2d]
-
-        piano_roll = np.zeros((self.n_notes, len(song)))
-
-        for index, notes in enumerate(song):
-            piano_roll[notes, index] = 1
-
-        piano_roll = self.filter_short_notes(piano_roll)
+        # the short notes are filtered after the merge since notes can overlap two blocks,
+        # on a copy since filter_short_notes modifies the stored raw piano roll in place
+        piano_roll = self.filter_short_notes(self.raw_piano_roll(engine, jobs).copy())
 
         song = [librosa.midi_to_hz(np.argwhere(
             piano_roll[:, i]) + self.note_min.midi).flatten() for i in np.arange(piano_roll.shape[1])]
@@ -251,6 +655,32 @@ class Pseudo2D(AudioParams):
 
 
 
+    @cached_property
+    def note_names(self) -> np.ndarray:
+        """
+        Name of every row of the piano roll in standard english notation. ex: 'C4', 'A#3'
+        """
+        return librosa.midi_to_note(np.arange(self.note_min.midi, self.note_max.midi + 1))
+
+    def iter_simple_notation(self, piano_roll: np.ndarray):
+        """
+        Lazy form of to_simple_notation_v2, yields the groups of simultaneous notes one at a time.
+
+        The frames where the piano roll changes are found all at once, the names of the notes of a group
+        are only looked up in note_names when the group is yielded.
+        """
+        n_frames = piano_roll.shape[1]
+        if n_frames == 0:
+            return
+        changes = np.flatnonzero(np.any(piano_roll[:, 1:] != piano_roll[:, :-1], axis=0)) + 1
+        starts = np.concatenate(([0], changes)).tolist()
+        # the last group stops one frame before the end of the piano roll
+        stops = np.concatenate((changes, [n_frames - 1])).tolist()
+        for start, stop in zip(starts, stops):
+            group = np.flatnonzero(piano_roll[:, start])
+            if group.size > 0:
+                yield (self.note_names[group].tolist(), start * self.hop_time, (stop - start) * self.hop_time)
+
     def to_simple_notation_v2(self, piano_roll: np.ndarray):
         """
         Group simultaneous notes together in piano_roll. Making it a good choice to create chords.
@@ -266,31 +696,7 @@ class Pseudo2D(AudioParams):
             list of tuples where
             the first element of the tuple is the note in standard english notation. ex: 'C4', 'A#3'
         """
-        simple_grouped_notes = []
-        i = 0
-        last_change = 0
-        for frame in piano_roll.T:
-            if  i > 0:
-                last_frame = piano_roll.T[i-1]
-            else:
-                last_frame = piano_roll.T[i]
-            last_group = np.nonzero(last_frame)[0]
-
-            if any(frame != last_frame):
-                # save the last_change time
-                # store the value of last frame
-                if last_group.size > 0:
-                    simple_grouped_notes.append((librosa.midi_to_note(last_group + self.note_min.midi).tolist(), last_change * self.hop_time, (i-last_change)*self.hop_time))
-                last_change = i
-
-            # handle the end of the piano roll
-            if i == len(piano_roll.T) - 1:
-                current_group = np.nonzero(frame > 0)[0]
-                if current_group.size > 0:
-                    simple_grouped_notes.append((librosa.midi_to_note(current_group+ self.note_min.midi).tolist(), last_change * self.hop_time, (i-last_change)*self.hop_time))
-            i += 1
-
-        return simple_grouped_notes
+        return list(self.iter_simple_notation(piano_roll))
 
     def show_multipitch_estimate(self, piano_roll: np.ndarray, ax=None):
         librosa.display.specshow(
@@ -309,12 +715,11 @@ class Pseudo2D(AudioParams):
     def show(self, time):
         frame = librosa.time_to_frames(
             time, sr=self.sampling_rate, hop_length=self.hop_length)
-        p2d = list(self.pseudo_2d)
-        if frame >= len(p2d):
-            raise ValueError(f"Time: {time} is out of bounds with time of the audio: {librosa.frames_to_time(len(p2d), sr=self.sampling_rate, hop_length=self.hop_length)}")
+        n_frames = self.cqt.shape[1]
+        if not 0 <= frame < n_frames:
+            raise ValueError(f"Time: {time} is out of bounds with time of the audio: {librosa.frames_to_time(n_frames, sr=self.sampling_rate, hop_length=self.hop_length)}")
 
-        from itertools import islice
-        i = list(islice(self.pseudo_2d, frame - 1, frame))[0]
+        i = self.frame(frame)
 
         cross_corr = self.cross_correlate_diag(i, _2D=True)
         fig, ax = plt.subplots(1, 3)
@@ -329,6 +734,198 @@ class Pseudo2D(AudioParams):
         plt.show()
 
 
+def rank1_profile(template_matrix: np.ndarray) -> np.ndarray:
+    """
+    1-D factor r of a template matrix, such that template_matrix == outer(r, r).
+
+    Raises:
+        ValueError: if the template matrix is not a rank-1 outer product of a non-negative vector.
+    """
+    profile = np.sqrt(np.abs(np.diag(template_matrix)))
+    if not np.allclose(np.outer(profile, profile), template_matrix):
+        raise ValueError("The template matrix is not a rank-1 outer product, use the 'fft' engine instead")
+    return profile
+
+
+def template_taps(template_matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sparse form of a template matrix: the non-zero entries as taps relative to the center of the template.
+
+    The log-compressed frame is symmetric so the taps (i, j) and (j, i) are folded into one.
+
+    Returns:
+        offsets: np.ndarray(K, 2) of int: (i, j) offsets of the taps with respect to the diagonal.
+        weights: np.ndarray(K,): weight of every tap.
+    """
+    center = template_matrix.shape[0] // 2
+    rows, cols = np.nonzero(template_matrix)
+    weights = template_matrix[rows, cols]
+    offsets = np.sort(np.column_stack((rows, cols)), axis=1) - center
+    offsets, inverse = np.unique(offsets, axis=0, return_inverse=True)
+    return offsets, np.bincount(inverse.ravel(), weights=weights, minlength=len(offsets))
+
+
+def merge_taps(taps: list[tuple[np.ndarray, np.ndarray]]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Union of the taps of several templates of the same size.
+
+    Returns:
+        offsets: np.ndarray(K, 2) of int: offsets of every tap used by at least one template.
+        weights: np.ndarray(T, K): weight of every tap for each template, 0 if the template does not use it.
+    """
+    offsets, inverse = np.unique(np.concatenate([offset for offset, _ in taps]), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    weights = np.zeros((len(taps), len(offsets)))
+    start = 0
+    for index, (offset, weight) in enumerate(taps):
+        weights[index, inverse[start:start + len(offset)]] = weight
+        start += len(offset)
+    return offsets, weights
+
+
+class StreamingPseudo2D(Pseudo2D):
+    """
+    Pseudo2D reading an audio file block by block.
+
+    Each block is analysed with enough context on both sides to compute the harmonic separation and the cqt of its frames
+    as if the whole file was loaded, so the memory used only depends on block_duration and not on the length of the file.
+    """
+    def __init__(self, path: str, block_duration: float = 60.0) -> None:
+        super().__init__(None)
+        self.path = path
+        self.block_frames = max(1, int(block_duration / self.hop_time))
+        self.stream = AudioStream(path, block_size=self.block_frames * self.hop_length)
+        # the hpss median filter spans 31 stft frames of n_fft=2048, hop=512
+        self.hpss_context = 15 * 512 + 2048
+
+    @cached_property
+    def context_frames(self) -> int:
+        """
+        Number of frames analysed on each side of a block so its cqt frames only depend on real audio.
+        """
+        freqs = librosa.cqt_frequencies(self.n_bins, fmin=self.note_min.hz, bins_per_octave=self.n_bins_per_octave)
+        lengths, _ = librosa.filters.wavelet_lengths(freqs=freqs, sr=self.sampling_rate, window='hann')
+        # + 2 frames of margin for the resampling filters used by librosa.cqt
+        return int(np.ceil((np.max(lengths) / 2 + self.hpss_context) / self.hop_length)) + 2
+
+    @cached_property
+    def n_frames(self) -> int:
+        """
+        Number of frames of the cqt of the whole file.
+        """
+        return 1 + self.stream.n_samples // self.hop_length
+
+    def cqt_blocks(self):
+        """
+        Yields the cqt of the file, block_frames columns at a time.
+
+        The samples are consumed from the stream as they are decoded, only the samples of the current block
+        and of its context are kept.
+        """
+        samples = self.stream.blocks()
+        # samples [offset, offset + len(buffer)) of the file
+        buffer, offset = np.zeros(0, dtype=np.float32), 0
+        for start in range(0, self.n_frames, self.block_frames):
+            stop = min(start + self.block_frames, self.n_frames)
+            first = max(start - self.context_frames, 0)
+            last = (stop + self.context_frames) * self.hop_length
+            buffer = buffer[first * self.hop_length - offset:]
+            offset = first * self.hop_length
+            chunks = [buffer]
+            while offset + sum(map(len, chunks)) < last:
+                chunk = next(samples, None)
+                if chunk is None:
+                    break
+                chunks.append(chunk)
+            buffer = np.concatenate(chunks)
+            cqt = self.compute_spectrum(librosa.effects.harmonic(buffer[:last - offset]))
+            yield cqt[:, start - first:stop - first]
+
+    def filter_short_notes_stream(self, piano_rolls):
+        """
+        Streaming equivalent of filter_short_notes.
+
+        The frames of the notes still playing at the end of the last block that are not long enough yet
+        are held back until the next block tells if they last at least min_length frames.
+        """
+        pending = np.zeros((self.n_notes, 0), dtype=self.float_dtype)
+        # length (up to min_length) of the note playing at the end of what was already yielded
+        carry = np.zeros(self.n_notes, dtype=int)
+
+        def filter_with_carry(piano_roll):
+            prefix = np.arange(self.min_length) >= self.min_length - carry[:, None]
+            filtered = self.filter_short_notes(np.concatenate((prefix, piano_roll), axis=1))
+            return filtered[:, self.min_length:]
+
+        for piano_roll in piano_rolls:
+            pending = np.concatenate((pending, piano_roll), axis=1)
+            # length of the note still playing at the end of pending
+            playing = np.argmin(pending[:, ::-1] > 0, axis=1)
+            playing[np.all(pending > 0, axis=1)] = pending.shape[1]
+            length = playing + np.where(playing == pending.shape[1], carry, 0)
+            undecided = (playing > 0) & (length < self.min_length)
+            cutoff = np.min(pending.shape[1] - playing[undecided], initial=pending.shape[1])
+
+            filtered = filter_with_carry(pending)[:, :cutoff]
+            if cutoff > 0:
+                ended = np.argmin(filtered[:, ::-1] > 0, axis=1)
+                ended[np.all(filtered > 0, axis=1)] = cutoff
+                carry = np.minimum(ended + np.where(ended == cutoff, carry, 0), self.min_length)
+            pending = pending[:, cutoff:]
+            yield filtered
+        yield filter_with_carry(pending)
+
+    def piano_roll_blocks(self, engine: str = "rank1"):
+        """
+        Yields the piano roll of the file block by block, with the short notes already filtered out.
+        The blocks do not all have block_frames columns since frames are held back by filter_short_notes_stream.
+        """
+        def raw_piano_rolls():
+            for cqt in self.cqt_blocks():
+                self.cqt = cqt
+                yield self.raw_piano_roll(engine)
+                del self.cqt
+
+        yield from self.filter_short_notes_stream(raw_piano_rolls())
+
+    def multipitch_estimate(self, engine: str = "rank1", jobs: int = 1):
+        """
+        Estimate the multipitch of the audio file one block at a time, jobs is ignored.
+        Returns: (song, piano_roll)
+            song: list of np.array of frequencies in hz
+            piano_roll: np.ndarray of shape (n_notes, n_frames)
+        """
+        piano_roll = np.concatenate(list(self.piano_roll_blocks(engine)), axis=1)
+        song = [librosa.midi_to_hz(np.argwhere(
+            piano_roll[:, i]) + self.note_min.midi).flatten() for i in np.arange(piano_roll.shape[1])]
+        return song, piano_roll
+
+    @cached_property
+    def tempo(self) -> float:
+        """
+        Tempo estimated on the first block of the file.
+        """
+        return self.stream.tempo(self.block_frames * self.hop_length)
+
+
+def _raw_piano_roll_block(shm_name, shape, dtype, start, stop, settings, engine):
+    """
+    Worker of Pseudo2D.parallel_raw_piano_roll, computes the cross-correlation and the raw piano roll of the frames
+    [start, stop) of the cqt stored in the shared memory block shm_name.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        pseudo = Pseudo2D(None)
+        pseudo.__dict__.update(settings)
+        pseudo.cqt = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[:, start:stop]
+        piano_roll = pseudo.raw_piano_roll(engine)
+        cross_correlation = pseudo.cross_correlation(engine, normalize=False)
+        del pseudo
+    finally:
+        shm.close()
+    return cross_correlation, piano_roll
+
+
 if __name__ == "__main__":
     # bunch of code to test functionnality
     audio = AudioSignal("song&samples/gamme_C.wav")
@@ -0,0 +1,144 @@
+"""
+On-disk library of instrument templates for the Pseudo2D multipitch estimation.
+
+A template is learned once from a single note sample of an instrument (see Pseudo2D.generate_template_from_audio_file)
+and stored as its 1-D harmonic profile, the next runs load it instead of analysing the sample again.
+The library is kept in MIR_TEMPLATE_DIR, ~/.mir/templates by default.
+"""
+import json
+import os
+import numpy as np
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mir.Cache import file_digest
+from mir.Pseudo2D import Pseudo2D, rank1_profile
+
+TEMPLATE_DIR = os.environ.get("MIR_TEMPLATE_DIR", os.path.join(os.path.expanduser("~"), ".mir", "templates"))
+
+
+class TemplateBank:
+    """
+    Versioned library of learned templates.
+    ----------
+    Methods:
+        learn(name, path, pseudo) -> return : template matrix
+        load(name, pseudo) -> return : template matrix
+        templates(pseudo, names) -> return : {name: template matrix}
+        remove(name)
+        check_name(name)
+    ----------
+    attributes:
+        names -> return : list of the stored templates
+    """
+    # bump when the way templates are learned changes, older templates are learned again
+    version = 1
+    synthetic = "synthetic"
+
+    def __init__(self, directory: str = TEMPLATE_DIR):
+        self.directory = directory
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, "index.json")
+
+    @property
+    def index(self) -> dict:
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            index = json.load(f)
+        return {name: entry for name, entry in index["templates"].items() if entry["version"] == self.version}
+
+    def _write_index(self, index: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "templates": index}, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    @property
+    def names(self) -> list[str]:
+        return sorted(self.index)
+
+    @staticmethod
+    def params(pseudo: Pseudo2D) -> dict:
+        """
+        Parameters of the estimator a template depends on.
+        """
+        return {"sampling_rate": pseudo.sampling_rate, "hop_length": pseudo.hop_length,
+                "note_min": pseudo.note_min.string, "note_max": pseudo.note_max.string,
+                "n_bins_per_octave": pseudo.n_bins_per_octave, "n_harmonics": pseudo.n_harmonics}
+
+    def check_name(self, name: str):
+        """
+        Raises
+        ------
+        ValueError : if name is not a plain file name, the template would be stored outside of the library.
+        """
+        if not name or name in (".", "..") or os.path.basename(name) != name:
+            raise ValueError(f"Invalid template name '{name}', please use a name without any path separator")
+
+    def learn(self, name: str, path: str, pseudo: Pseudo2D) -> np.ndarray:
+        """
+        Learn the template name from the single note sample at path and store it.
+        Nothing is computed if the same sample was already learned with the same parameters.
+
+        Raises
+        ------
+        ValueError : if name is 'synthetic' or is not a plain file name, see check_name.
+
+        Returns
+        -------
+        template_matrix : np.ndarray
+        """
+        if name == self.synthetic:
+            raise ValueError(f"'{self.synthetic}' is reserved for the harmonic comb of Pseudo2D")
+        self.check_name(name)
+        digest = file_digest(path)
+        entry = self.index.get(name)
+        if entry is not None and entry["digest"] == digest and entry["params"] == self.params(pseudo):
+            return self.load(name, pseudo)
+
+        profile = rank1_profile(pseudo.generate_template_from_audio_file(path))
+        os.makedirs(self.directory, exist_ok=True)
+        np.save(os.path.join(self.directory, name + ".npy"), profile)
+        index = self.index
+        index[name] = {"file": name + ".npy", "sample": os.path.abspath(path), "digest": digest,
+                       "params": self.params(pseudo), "version": self.version}
+        self._write_index(index)
+        return np.outer(profile, profile)
+
+    def load(self, name: str, pseudo: Pseudo2D) -> np.ndarray:
+        """
+        Load the template name, 'synthetic' is the harmonic comb of the estimator.
+
+        Raises
+        ------
+        KeyError : if the template is not in the library or was learned with other parameters than the estimator.
+        """
+        if name == self.synthetic:
+            return pseudo.harmonic_comb()
+        entry = self.index.get(name)
+        if entry is None:
+            raise KeyError(f"No template named '{name}', available templates: {self.names}")
+        if entry["params"] != self.params(pseudo):
+            raise KeyError(f"The template '{name}' was learned with other parameters, please learn it again")
+        profile = np.load(os.path.join(self.directory, entry["file"]))
+        return np.outer(profile, profile)
+
+    def templates(self, pseudo: Pseudo2D, names: list[str] | None = None) -> dict:
+        """
+        {name: template matrix} of the requested templates, every stored template and the synthetic one by default.
+        """
+        names = [self.synthetic] + self.names if names is None else names
+        return {name: self.load(name, pseudo) for name in names}
+
+    def remove(self, name: str):
+        self.check_name(name)
+        index = self.index
+        entry = index.pop(name)
+        os.remove(os.path.join(self.directory, entry["file"]))
+        self._write_index(index)
+
+
+template_bank = TemplateBank()
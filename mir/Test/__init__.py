@@ -1 +1,16 @@
+"""
+The tests use a cache of their own, removed at the end of the run, the cache of the user is never read nor written.
+"""
+import atexit
+import os
+import shutil
+import tempfile
 
+CACHE_DIR = tempfile.mkdtemp(prefix="mir-test-cache-")
+atexit.register(shutil.rmtree, CACHE_DIR, ignore_errors=True)
+# read by mir.Cache when it is imported, and by the processes started by the tests
+os.environ["MIR_CACHE_DIR"] = CACHE_DIR
+
+from mir.Cache import feature_cache
+# in case mir.Cache was imported before the tests
+feature_cache.directory = CACHE_DIR
@@ -1,11 +1,12 @@
 import unittest
 import numpy as np
+import librosa
 from unittest.mock import patch
 import sys,os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from mir.MIR_lib import build_transition_matrix
-from mir.MusicRetrieval import Note, AudioParams, AudioSignal, Mono
+from mir.MIR_lib import build_transition_matrix, classify_case, classify_cases, note_hmm, viterbi_batch
+from mir.MusicRetrieval import Note, AudioParams, AudioSignal, AudioStream, MonoParams, Mono, StreamingMono
 filepath = os.path.abspath(os.path.dirname(__file__))
 AUDIO_PATH = f'{filepath}/simple_note_progression.wav'
 
@@ -46,12 +47,76 @@ class TestAudioParams(unittest.TestCase):
         self.assertEqual(audio_params.note_min.string, 'E2')
         self.assertEqual(audio_params.note_max.string, 'C7')
 
+    def test_decimation(self):
+        audio_params = AudioParams()
+        self.assertEqual(audio_params.decimation(), 1)
+        self.assertEqual(audio_params.decimation(4186), 2)
+        self.assertEqual(audio_params.decimation(1000), 8)
+        audio_params.hop_length = 100
+        self.assertEqual(audio_params.decimation(1000), 4)
+
 class TestAudioSignal(unittest.TestCase):
     def test_audio_signal_initialization(self):
         audio_signal = AudioSignal(AUDIO_PATH)
         self.assertEqual(audio_signal.sampling_rate, 22050)
         self.assertGreater(len(audio_signal.y), 0)
 
+    def test_lazy_hpss(self):
+        audio_signal = AudioSignal(AUDIO_PATH)
+        self.assertNotIn("hpss", vars(audio_signal))
+        self.assertNotIn("tempo", vars(audio_signal))
+        np.testing.assert_array_equal(audio_signal.y_harmonic, librosa.effects.harmonic(audio_signal.y))
+        np.testing.assert_array_equal(audio_signal.y_percussive, librosa.effects.percussive(audio_signal.y))
+        self.assertGreater(audio_signal.tempo, 0)
+
+class TestFeatureStore(unittest.TestCase):
+    def setUp(self):
+        self.audio = AudioSignal(AUDIO_PATH)
+
+    def test_computed_once(self):
+        features = self.audio.features
+        self.assertIs(features, self.audio.features)
+        self.assertIs(features.chroma(), features.chroma())
+        self.assertIs(features.onset_envelope(), features.onset_envelope())
+
+    def test_chroma(self):
+        chroma = self.audio.features.chroma("y_harmonic")
+        expected = librosa.feature.chroma_cqt(y=self.audio.y_harmonic, sr=self.audio.sampling_rate,
+                                              hop_length=self.audio.hop_length)
+        self.assertEqual(chroma.shape, expected.shape)
+        self.assertEqual(np.max(chroma), 1)
+        np.testing.assert_allclose(chroma, expected, atol=0.02)
+        self.assertAlmostEqual(self.audio.features.tuning("y_harmonic"), librosa.estimate_tuning(
+            y=self.audio.y_harmonic, sr=self.audio.sampling_rate, bins_per_octave=36))
+
+    def test_decimated_signal(self):
+        features = self.audio.features
+        self.assertIs(features.signal("y", 1), self.audio.y)
+        self.assertEqual(len(features.signal("y", 2)), int(np.ceil(len(self.audio.y) / 2)))
+        self.assertEqual(features.cqt().shape[1], features.n_frames())
+
+    def test_onsets_and_tempo(self):
+        y, sr, hop_length = self.audio.y_percussive, self.audio.sampling_rate, self.audio.hop_length
+        np.testing.assert_array_equal(self.audio.features.onsets(),
+                                      librosa.onset.onset_detect(y=y, sr=sr, hop_length=hop_length, backtrack=True))
+        self.assertEqual(self.audio.tempo, librosa.feature.tempo(y=y, sr=sr, hop_length=hop_length)[0])
+
+class TestAudioStream(unittest.TestCase):
+    def test_blocks(self):
+        path = "song&samples/polyphonic.wav"
+        stream = AudioStream(path, block_size=10000)
+        blocks = list(stream.blocks())
+        self.assertTrue(all(len(block) == 10000 for block in blocks[:-1]))
+        y = np.concatenate(blocks)
+        expected = AudioSignal(path).y
+        self.assertEqual(stream.n_samples, len(expected))
+        np.testing.assert_array_equal(y, expected)
+        np.testing.assert_array_equal(stream.head(15000), expected[:15000])
+
+    def test_native_sampling_rate(self):
+        stream = AudioStream(AUDIO_PATH, block_size=4096)
+        np.testing.assert_array_equal(np.concatenate(list(stream.blocks())), AudioSignal(AUDIO_PATH).y)
+
 class TestPrior(unittest.TestCase):
     def test_prior_probability(self):
         audio_signal = AudioSignal(AUDIO_PATH)
@@ -60,6 +125,96 @@ class TestPrior(unittest.TestCase):
         state_size = 2 * n_note + 1
         self.assertEqual(priors.shape[0], state_size)
 
+class TestPrecision(unittest.TestCase):
+    def tearDown(self):
+        AudioParams.precision = "double"
+
+    def test_invalid_precision(self):
+        audio_params = AudioParams()
+        audio_params.precision = "half"
+        with self.assertRaises(ValueError):
+            audio_params.float_dtype
+
+    def test_single_precision_mono(self):
+        AudioParams.precision = "single"
+        mono = Mono(AudioSignal(AUDIO_PATH))
+        self.assertEqual(mono.priors.dtype, np.float32)
+        self.assertEqual(mono.transition_matrix.dtype, np.float32)
+        AudioParams.precision = "double"
+        expected = Mono(AudioSignal(AUDIO_PATH))
+        np.testing.assert_array_equal(mono.decoded_states, expected.decoded_states)
+
+class TestNoteHMM(unittest.TestCase):
+    def test_shared_model(self):
+        hmm = note_hmm(61, 0.9, 0.5)
+        self.assertIs(note_hmm(61, 0.9, 0.5), hmm)
+        self.assertIsNot(note_hmm(61, 0.8, 0.5), hmm)
+        self.assertFalse(hmm.transition_matrix.flags.writeable)
+        np.testing.assert_allclose(hmm.transition_matrix[0::2].sum(axis=1), 1)
+        self.assertAlmostEqual(hmm.p_init.sum(), 1)
+
+    def test_classify_cases(self):
+        expected = [[classify_case(i, j).value for j in range(7)] for i in range(7)]
+        np.testing.assert_array_equal(classify_cases(7), expected)
+
+    def test_viterbi(self):
+        hmm = note_hmm(5, 0.9, 0.5)
+        prob = np.random.default_rng(0).random((hmm.n_states, 500)) ** 4
+        prob /= prob.sum(axis=0)
+        for dtype in (np.float64, np.float32):
+            expected = librosa.sequence.viterbi(prob.astype(dtype), hmm.transition_matrix.astype(dtype),
+                                                p_init=hmm.p_init.astype(dtype))
+            np.testing.assert_array_equal(hmm.viterbi(prob.astype(dtype)), expected)
+
+    def test_viterbi_single_precision(self):
+        # the values drift from librosa after a few thousand frames if they are accumulated in float32
+        hmm = note_hmm(57, 0.9, 0.5)
+        prob = np.random.default_rng(1).random((hmm.n_states, 30000)) ** 8
+        prob = (prob / prob.sum(axis=0)).astype(np.float32)
+        expected = librosa.sequence.viterbi(prob, hmm.transition_matrix.astype(np.float32),
+                                            p_init=hmm.p_init.astype(np.float32))
+        np.testing.assert_array_equal(hmm.viterbi(prob), expected)
+
+    def test_viterbi_batch(self):
+        hmm = note_hmm(5, 0.9, 0.5)
+        rng = np.random.default_rng(0)
+        # a recording without observation ties every state
+        probs = [rng.random((hmm.n_states, length)) ** 4 for length in (300, 1, 120)] + [np.ones((hmm.n_states, 50))]
+        for states, prob in zip(hmm.viterbi_batch(probs), probs):
+            np.testing.assert_array_equal(states, hmm.viterbi(prob))
+        self.assertEqual(hmm.viterbi_batch([]), [])
+
+    def test_viterbi_batch_single_precision(self):
+        hmm = note_hmm(57, 0.9, 0.5)
+        rng = np.random.default_rng(2)
+        probs = []
+        for length in (30000, 12000, 25000):
+            prob = rng.random((hmm.n_states, length)) ** 8
+            probs.append((prob / prob.sum(axis=0)).astype(np.float32))
+        for states, prob in zip(hmm.viterbi_batch(probs), probs):
+            np.testing.assert_array_equal(states, librosa.sequence.viterbi(
+                prob, hmm.transition_matrix.astype(np.float32), p_init=hmm.p_init.astype(np.float32)))
+
+    def test_dense_viterbi_batch(self):
+        rng = np.random.default_rng(0)
+        uniform = np.full((6, 6), 0.1)
+        np.fill_diagonal(uniform, 0.5)
+        uniform[0] = 0.15
+        uniform[0, 0] = 0.25
+        dense = rng.random((6, 6))
+        # coarse probabilities give ties between the paths
+        probs = [np.round(rng.random((6, length)), 1) for length in (200, 1, 80)]
+        for transition in (uniform, dense / dense.sum(axis=1, keepdims=True)):
+            for states, prob in zip(viterbi_batch(probs, transition), probs):
+                np.testing.assert_array_equal(states, librosa.sequence.viterbi(prob, transition))
+
+    def test_mono_model(self):
+        mono = Mono(AudioSignal(AUDIO_PATH))
+        self.assertIs(mono.hmm, note_hmm(mono.n_notes, mono.prob_stay_note, mono.prob_stay_silence))
+        np.testing.assert_array_equal(mono.transition_matrix, build_transition_matrix(mono.n_notes))
+        np.testing.assert_array_equal(mono.encoded_states, librosa.sequence.viterbi(
+            mono.priors, mono.transition_matrix, p_init=mono.p_init))
+
 class TestMono(unittest.TestCase):
     def test_custom_hmm(self):
         audio_signal = AudioSignal(AUDIO_PATH)
@@ -67,6 +222,104 @@ class TestMono(unittest.TestCase):
         resolved_states = mono.decoded_states
         self.assertEqual(len(resolved_states), mono.priors.shape[1])
 
+    def test_state_names(self):
+        mono = Mono(AudioSignal(AUDIO_PATH))
+        names = mono.state_names
+        self.assertEqual(len(names), mono.n_notes * 2 + 1)
+        self.assertEqual(names[0], "N")
+        self.assertEqual(names[1], names[2])
+        self.assertEqual(names[2 * (60 - mono.note_min.midi) + 1], librosa.midi_to_note(60))
+        states = np.array([0, 0, 25, 26, 26, 27, 28, 27, 0, 1])
+        self.assertEqual(mono.simple_notation(states), mono.simple_notation(mono.state_notes(states)))
+        piano_roll = mono.state_piano_roll(states)
+        self.assertEqual(piano_roll.shape, (mono.n_notes, len(states)))
+        np.testing.assert_array_equal(piano_roll.sum(axis=0), states > 0)
+        np.testing.assert_array_equal(np.flatnonzero(piano_roll[12]), [2, 3, 4])
+
+    def test_decode_batch(self):
+        monos = [Mono(AudioSignal(AUDIO_PATH)), Mono(AudioSignal('song&samples/gamme_C.wav'))]
+        states = Mono.decode_batch(monos)
+        for mono, mono_states in zip(monos, states):
+            self.assertIs(mono.encoded_state, mono_states)
+            np.testing.assert_array_equal(mono_states, mono.hmm.viterbi(mono.priors))
+
+    def test_no_hmm(self):
+        mono = Mono(AudioSignal(AUDIO_PATH))
+        piano_roll = mono.no_hmm()
+        self.assertEqual(piano_roll.shape, (mono.n_notes, len(mono.pitch)))
+        # the unvoiced frames have no note
+        self.assertFalse(np.any(piano_roll[:, np.isnan(mono.pitch)]))
+        self.assertTrue(np.all(piano_roll.sum(axis=0) <= 1))
+
+class TestYin(unittest.TestCase):
+    def setUp(self):
+        self.params = MonoParams()
+        self.params.pitch_backend = "yin"
+
+    def test_sine(self):
+        t = np.arange(22050) / 22050
+        y = np.concatenate((np.sin(2 * np.pi * 440 * t), np.zeros(11025)))
+        f0, voiced_flag, voiced_prob = self.params.pitch_track(y)
+        self.assertEqual(len(f0), 1 + len(y) // self.params.hop_length)
+        np.testing.assert_allclose(f0[5:35], 440, rtol=1e-3)
+        self.assertTrue(np.all(voiced_flag[5:35]))
+        self.assertTrue(np.all(np.isnan(f0[50:])))
+        self.assertTrue(np.all((voiced_prob >= 0) & (voiced_prob <= 1)))
+
+    def test_unknown_backend(self):
+        self.params.pitch_backend = "crepe"
+        with self.assertRaises(ValueError):
+            self.params.pitch_track(np.zeros(4096))
+
+    def test_mono(self):
+        audio_signal = AudioSignal(AUDIO_PATH)
+        pyin = Mono(audio_signal)
+        yin = Mono(audio_signal, pitch_backend="yin")
+        self.assertEqual(yin.pitch.shape, pyin.pitch.shape)
+        self.assertEqual([note for note, _, _ in yin.simple_notation(yin.decoded_states)],
+                         [note for note, _, _ in pyin.simple_notation(pyin.decoded_states)])
+
+class TestStreamingMono(unittest.TestCase):
+    def test_transcribe(self):
+        mono = Mono(AudioSignal(AUDIO_PATH))
+        expected = mono.simple_notation(mono.decoded_states)
+        streaming = StreamingMono(lag=0.25, block_duration=0.25)
+        pushed = []
+        for block in AudioStream(AUDIO_PATH, block_size=2048).blocks():
+            pushed += streaming.push(block)
+        notes = pushed + streaming.flush()
+        # the first notes are emitted while the signal is still coming
+        self.assertGreater(len(pushed), 0)
+        self.assertEqual([note for note, _, _ in notes], [note for note, _, _ in expected])
+        self.assertAlmostEqual(sum(duration for _, _, duration in notes), len(mono.pitch) * mono.hop_time)
+        for (_, onset, duration), (_, expected_onset, _) in zip(notes[1:], expected[1:]):
+            self.assertAlmostEqual(onset, expected_onset, delta=0.05)
+
+    def test_empty(self):
+        self.assertEqual(StreamingMono().flush(), [])
+
+    def test_tuning(self):
+        streaming = StreamingMono()
+        f0 = librosa.midi_to_hz(np.random.default_rng(0).normal(60.2, 0.05, 3000))
+        f0[::7] = np.nan
+        for block in np.array_split(f0, 10):
+            streaming.add_pitches(block)
+        self.assertEqual(streaming.tuning, librosa.pitch_tuning(f0))
+
+    def test_long_stream(self):
+        streaming = StreamingMono(lag=0.5, block_duration=0.5)
+        streaming.pitch_backend = "yin"
+        sr = streaming.sampling_rate
+        # a tone 30 cents sharp, pushed for a minute
+        y = 0.5 * np.sin(2 * np.pi * librosa.midi_to_hz(69.3) * np.arange(60 * sr) / sr)
+        sizes = []
+        for block in np.array_split(y, 120):
+            streaming.push(block)
+            sizes.append(len(streaming.buffer) + len(streaming.ptr))
+        # the state of the decoder does not grow with the signal
+        self.assertLessEqual(max(sizes[60:]), max(sizes[:60]))
+        self.assertAlmostEqual(streaming.tuning, 0.3, delta=0.02)
+
 class TestPostprocessor(unittest.TestCase):
     def test_postprocessor_simple_notation(self):
         audio_signal = AudioSignal(AUDIO_PATH)
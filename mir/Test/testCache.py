@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+import unittest
+import librosa
+import numpy as np
+from unittest.mock import patch
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from mir.Cache import FeatureCache
+from mir.MusicRetrieval import AudioSignal
+from mir.Pseudo2D import Pseudo2D
+
+
+class TestFeatureCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = FeatureCache(self.directory.name, max_size=16 * 1024**2)
+        self.params = {"sampling_rate": 22050, "hop_length": 512}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_key_depends_on_params(self):
+        key = self.cache.key("cqt", "abc", self.params)
+        self.assertEqual(key, self.cache.key("cqt", "abc", dict(self.params)))
+        self.assertNotEqual(key, self.cache.key("cqt", "abc", {**self.params, "hop_length": 256}))
+        self.assertNotEqual(key, self.cache.key("cqt", "abd", self.params))
+        self.assertNotEqual(key, self.cache.key("chroma_cqt", "abc", self.params))
+
+    def test_key_depends_on_version(self):
+        key = self.cache.key("cqt", "abc", self.params)
+        with patch.dict(FeatureCache.versions, {"cqt": FeatureCache.versions["cqt"] + 1}):
+            self.assertNotEqual(key, self.cache.key("cqt", "abc", self.params))
+
+    def test_get_computes_once(self):
+        calls = []
+        def compute():
+            calls.append(1)
+            return np.arange(10, dtype=np.complex64)
+        first = self.cache.get("cqt", "abc", self.params, compute)
+        second = self.cache.get("cqt", "abc", self.params, compute)
+        self.assertEqual(len(calls), 1)
+        self.assertIsInstance(second, np.memmap)
+        np.testing.assert_array_equal(first, second)
+
+    def test_eviction(self):
+        cache = FeatureCache(self.directory.name, max_size=1200)
+        for i in range(3):
+            cache.get("cqt", str(i), self.params, lambda: np.zeros(50))
+            os.utime(cache.path(cache.key("cqt", str(i), self.params)), (i, i))
+        files = os.listdir(self.directory.name)
+        self.assertEqual(len(files), 2)
+        self.assertNotIn(cache.key("cqt", "0", self.params) + ".npy", files)
+
+    def test_disabled(self):
+        cache = FeatureCache(self.directory.name, max_size=0)
+        cache.get("cqt", "abc", self.params, lambda: np.zeros(5))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_decoded_audio(self):
+        path = "song&samples/polyphonic.wav"
+        with patch("mir.MusicRetrieval.feature_cache", self.cache):
+            y = AudioSignal(path).y
+            with patch("librosa.load") as load:
+                cached = AudioSignal(path).y
+            load.assert_not_called()
+        self.assertIsInstance(cached, np.memmap)
+        self.assertFalse(cached.flags.writeable)
+        np.testing.assert_array_equal(y, librosa.load(path, sr=22050)[0])
+        np.testing.assert_array_equal(cached, y)
+
+    def test_pseudo2d_cqt(self):
+        audio = AudioSignal("song&samples/polyphonic.wav")
+        audio.cache = self.cache
+        cqt = Pseudo2D(audio).cqt
+        # the estimators of the same recording share the cqt through its feature store
+        self.assertIs(Pseudo2D(audio).cqt, cqt)
+        audio = AudioSignal("song&samples/polyphonic.wav")
+        audio.cache = self.cache
+        cached = Pseudo2D(audio)
+        self.assertIsInstance(cached.cqt, np.memmap)
+        np.testing.assert_array_equal(cqt, cached.cqt)
@@ -15,7 +15,10 @@ class TestChordIdentifier(unittest.TestCase):
         self.chord_identifier = ChordIdentifier(self.audio)
 
     def test_initialization(self):
-        self.assertTrue(np.array_equal(self.chord_identifier.chroma, self.chroma))
+        self.assertEqual(self.chord_identifier.chroma.shape, self.chroma.shape)
+        # the shared cqt is computed on a decimated signal, the chroma is close to the one of librosa
+        np.testing.assert_allclose(self.chord_identifier.chroma, self.chroma, atol=0.12)
+        self.assertLess(np.mean(np.abs(self.chord_identifier.chroma - self.chroma)), 0.005)
 
     def test_chord_labels(self):
         expected_labels = [
@@ -67,6 +70,13 @@ class TestChordIdentifier(unittest.TestCase):
             self.assertAlmostEqual(simple_notation[i][1], expected_notation[i][1], delta=1e-3)
             self.assertAlmostEqual(simple_notation[i][2], expected_notation[i][2], delta=1e-3)
 
+    def test_solve_batch(self):
+        other = ChordIdentifier(AudioSignal('song&samples/gamme_C.wav'))
+        sequences = ChordIdentifier.solve_batch([self.chord_identifier, other])
+        self.assertEqual(len(sequences), 2)
+        np.testing.assert_array_equal(sequences[0], self.chord_identifier.solve())
+        np.testing.assert_array_equal(sequences[1], other.solve())
+
     @unittest.skip("Just to avoid showing the plot during testing.")
     def test_show_method(self):
         # Since show() produces a plot, we can't directly test it in the same way.
@@ -1,5 +1,5 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, PropertyMock
 import argparse
 import sys
 import os
@@ -51,6 +51,68 @@ class TestArgumentParsing(unittest.TestCase):
         self.assertEqual(args.Modes, 'polyphonic')
         self.assertEqual(args.file, 'test.wav')
 
+    def test_parse_args_polyphonic_engine(self):
+        args = parse_args(['polyphonic', '-f', 'test.wav'])
+        self.assertEqual(args.engine, 'fft')
+        args = parse_args(['polyphonic', '--engine', 'rank1', '-f', 'test.wav'])
+        self.assertEqual(args.engine, 'rank1')
+
+    def test_parse_args_polyphonic_jobs(self):
+        args = parse_args(['polyphonic', '-f', 'test.wav'])
+        self.assertEqual(args.jobs, 1)
+        args = parse_args(['polyphonic', '--jobs', '4', '-f', 'test.wav'])
+        self.assertEqual(args.jobs, 4)
+
+    def test_parse_args_polyphonic_front_end(self):
+        args = parse_args(['polyphonic', '-f', 'test.wav'])
+        self.assertEqual(args.front_end, 'cqt')
+        args = parse_args(['polyphonic', '--front-end', 'logstft', '-f', 'test.wav'])
+        self.assertEqual(args.front_end, 'logstft')
+
+    def test_parse_args_polyphonic_stream(self):
+        args = parse_args(['polyphonic', '-f', 'test.wav'])
+        self.assertFalse(args.stream)
+        args = parse_args(['polyphonic', '--stream', '-f', 'test.wav'])
+        self.assertTrue(args.stream)
+
+    def test_parse_args_polyphonic_stream_jobs(self):
+        with self.assertRaises(SystemExit) as cm:
+            with patch('sys.stderr', new=StringIO()):
+                parse_args(['polyphonic', '--stream', '--jobs', '2', '-f', 'test.wav'])
+        self.assertEqual(cm.exception.code, 2)
+
+    def test_parse_args_monophonic_stream(self):
+        args = parse_args(['monophonic', '-f', 'test.wav'])
+        self.assertFalse(args.stream)
+        args = parse_args(['monophonic', '--stream', '--lag', '0.5', '-f', 'test.wav'])
+        self.assertTrue(args.stream)
+        self.assertEqual(args.lag, 0.5)
+
+    def test_parse_args_monophonic_pitch_backend(self):
+        args = parse_args(['monophonic', '-f', 'test.wav'])
+        self.assertEqual(args.pitch_backend, 'pyin')
+        args = parse_args(['monophonic', '--pitch-backend', 'yin', '-f', 'test.wav'])
+        self.assertEqual(args.pitch_backend, 'yin')
+
+    def test_parse_args_polyphonic_template(self):
+        args = parse_args(['polyphonic', '--template', 'piano', '--template-sample', 'a4.wav', '-f', 'test.wav'])
+        self.assertEqual(args.template, 'piano')
+        self.assertEqual(args.template_sample, 'a4.wav')
+
+    def test_parse_args_precision(self):
+        args = parse_args(['monophonic', '-f', 'test.wav'])
+        self.assertEqual(args.precision, 'double')
+        args = parse_args(['polyphonic', '--precision', 'single', '-f', 'test.wav'])
+        self.assertEqual(args.precision, 'single')
+
+    def test_parse_args_tune(self):
+        args = parse_args(['tune', 'a.midi', 'b.midi', '-t', '0.4', '0.5', '-j', '2'])
+        self.assertEqual(args.Modes, 'tune')
+        self.assertEqual(args.pieces, ['a.midi', 'b.midi'])
+        self.assertEqual(args.threshold, [0.4, 0.5])
+        self.assertEqual(args.gamma, [550])
+        self.assertEqual(args.jobs, 2)
+
     def test_parse_args_chord_only_mode(self):
         with patch('sys.stdout', new=StringIO()):
             args = parse_args(['chord-only', '-f', 'test.wav'])
@@ -107,6 +169,16 @@ class TestIntegration(unittest.TestCase):
         # assert it as content
         self.assertGreater(os.path.getsize(self.output_file), 0)
 
+    def test_main_polyphonic_stream(self):
+        output = StringIO()
+        with patch('sys.stdout', new=output), patch('mir.__main__.Partition') as partition, \
+                patch('mir.Pseudo2D.StreamingPseudo2D.tempo', new_callable=PropertyMock) as tempo:
+            main(['polyphonic', '--stream', '-f', self.file])
+        # without -o no score is engraved, the tempo is not estimated
+        partition.assert_not_called()
+        tempo.assert_not_called()
+        self.assertIn("(", output.getvalue())
+
     def test_polyphonic_benchmark(self):
         output = StringIO()
         with self.assertRaises(SystemExit) as cm:
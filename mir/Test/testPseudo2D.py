@@ -2,8 +2,9 @@ import sys
 from types import GeneratorType
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
-from mir.Pseudo2D import Pseudo2D
+from mir.Pseudo2D import Pseudo2D, StreamingPseudo2D
 import unittest
+from unittest.mock import patch
 from mir.MusicRetrieval import AudioSignal
 import numpy as np
 
@@ -18,6 +19,18 @@ class TestPseudo2D(unittest.TestCase):
     def test_get_pseudo_2d(self):
         self.assertIsInstance(self.pseudo.pseudo_2d, GeneratorType)
 
+    def test_frame(self):
+        np.testing.assert_array_equal(self.pseudo.frame(0), next(self.pseudo.pseudo_2d))
+        n_frames = self.pseudo.cqt.shape[1]
+        with self.assertRaises(IndexError):
+            self.pseudo.frame(n_frames)
+
+    def test_frames_between(self):
+        frames = list(self.pseudo.frames_between(1, 2))
+        first = int(1 / self.pseudo.hop_time)
+        self.assertEqual(len(frames), int(2 / self.pseudo.hop_time) - first)
+        np.testing.assert_array_equal(frames[0], self.pseudo.frame(first))
+
     def test_cross_correlate_diag(self):
         for i in self.pseudo.pseudo_2d:
             cross_corr = self.pseudo.cross_correlate_diag(i)
@@ -29,6 +42,125 @@ class TestPseudo2D(unittest.TestCase):
             self.assertIsInstance(conv, np.ndarray)
 
 
+    def test_rank1_engine(self):
+        cross_corr = self.pseudo.cross_correlation(engine="rank1")
+        expected = self.pseudo.cross_correlation(engine="fft")
+        self.assertEqual(cross_corr.shape, self.pseudo.cqt.shape)
+        np.testing.assert_allclose(cross_corr, expected, atol=1e-4)
+        _, piano = self.pseudo.multipitch_estimate(engine="rank1")
+        _, expected_piano = self.pseudo.multipitch_estimate(engine="fft")
+        np.testing.assert_array_equal(piano, expected_piano)
+
+    def test_sparse_engine(self):
+        expected = self.pseudo.cross_correlation(engine="fft")
+        np.testing.assert_allclose(self.pseudo.cross_correlation(engine="sparse"), expected, atol=1e-4)
+        _, piano = self.pseudo.multipitch_estimate(engine="sparse")
+        _, expected_piano = self.pseudo.multipitch_estimate(engine="fft")
+        np.testing.assert_array_equal(piano, expected_piano)
+
+    def test_sparse_engine_any_template(self):
+        self.pseudo.template_matrix = self.pseudo.template_matrix + 0.01 * np.eye(self.pseudo.template_matrix.shape[0])
+        with self.assertRaises(ValueError):
+            self.pseudo.cross_correlation(engine="rank1")
+        np.testing.assert_allclose(self.pseudo.cross_correlation(engine="sparse"),
+                                   self.pseudo.cross_correlation(engine="fft"), atol=1e-4)
+
+    def test_single_precision(self):
+        audio = AudioSignal("song&samples/polyphonic.wav")
+        audio.precision = "single"
+        pseudo = Pseudo2D(audio)
+        self.assertEqual(pseudo.cqt.dtype, np.complex64)
+        self.assertEqual(pseudo.frame(0).dtype, np.complex64)
+        # the fft engine also returns the silent frames, below std_threshold, in single precision
+        for engine in pseudo.engines:
+            self.assertEqual(pseudo.cross_correlation(engine=engine).dtype, np.float32)
+        _, piano = pseudo.multipitch_estimate(engine="sparse")
+        _, expected_piano = self.pseudo.multipitch_estimate(engine="sparse")
+        self.assertEqual(piano.dtype, np.float32)
+        np.testing.assert_array_equal(piano, expected_piano)
+
+    def test_parallel_multipitch_estimate(self):
+        song, piano = self.pseudo.multipitch_estimate(jobs=2)
+        expected_song, expected_piano = Pseudo2D(self.audio).multipitch_estimate()
+        np.testing.assert_array_equal(piano, expected_piano)
+        self.assertEqual(len(song), len(expected_song))
+        # the cross-correlation of the workers is kept, a new threshold only runs the peak picking again
+        cross_corr = self.pseudo.cross_correlation(normalize=False)
+        self.pseudo.threshold = 0.7
+        with patch("mir.Pseudo2D.Pseudo2D.parallel_raw_piano_roll") as parallel:
+            _, piano_07 = self.pseudo.multipitch_estimate(jobs=2)
+        parallel.assert_not_called()
+        self.assertIs(self.pseudo.cross_correlation(normalize=False), cross_corr)
+        expected = Pseudo2D(self.audio)
+        expected.threshold = 0.7
+        np.testing.assert_array_equal(piano_07, expected.multipitch_estimate()[1])
+
+    def test_staged_threshold(self):
+        _, piano = self.pseudo.multipitch_estimate(engine="sparse")
+        cross_corr = self.pseudo.cross_correlation(engine="sparse", normalize=False)
+        self.pseudo.threshold = 0.7
+        _, piano_07 = self.pseudo.multipitch_estimate(engine="sparse")
+        self.assertIs(self.pseudo.cross_correlation(engine="sparse", normalize=False), cross_corr)
+        expected = Pseudo2D(self.audio)
+        expected.threshold = 0.7
+        np.testing.assert_array_equal(piano_07, expected.multipitch_estimate(engine="sparse")[1])
+        self.pseudo.threshold = 0.54
+        np.testing.assert_array_equal(self.pseudo.multipitch_estimate(engine="sparse")[1], piano)
+
+    def test_staged_gamma(self):
+        cqt = self.pseudo.cqt
+        cross_corr = self.pseudo.cross_correlation(engine="rank1")
+        self.pseudo.gamma = 10
+        gamma_10 = self.pseudo.cross_correlation(engine="rank1")
+        self.assertIs(self.pseudo.cqt, cqt)
+        self.assertFalse(np.allclose(gamma_10, cross_corr))
+        expected = Pseudo2D(self.audio)
+        expected.gamma = 10
+        np.testing.assert_array_equal(gamma_10, expected.cross_correlation(engine="rank1"))
+
+    def test_staged_template(self):
+        template = self.pseudo.template_matrix
+        self.pseudo.n_harmonics = 4
+        self.assertGreater(self.pseudo.template_matrix.shape[0], template.shape[0])
+        self.pseudo.template_matrix = template
+        self.pseudo.n_harmonics = 5
+        self.assertIs(self.pseudo.template_matrix, template)
+
+    def test_staged_cqt(self):
+        cross_corr = self.pseudo.cross_correlation(engine="rank1")
+        self.pseudo.cqt = self.pseudo.cqt[:, :10]
+        self.assertEqual(self.pseudo.cross_correlation(engine="rank1").shape[1], 10)
+        del self.pseudo.cqt
+        np.testing.assert_array_equal(self.pseudo.cross_correlation(engine="rank1"), cross_corr)
+
+    def test_logstft_front_end(self):
+        self.pseudo.front_end = "logstft"
+        spectrum = self.pseudo.cqt
+        self.assertEqual(spectrum.shape, (self.pseudo.n_bins, self.audio.y_harmonic.size // self.pseudo.hop_length + 1))
+        self.assertEqual(spectrum.dtype, np.float64)
+        np.testing.assert_allclose(self.pseudo.cross_correlation(engine="sparse"),
+                                   self.pseudo.cross_correlation(engine="fft"), atol=1e-4)
+        self.pseudo.front_end = "cqt"
+        self.assertTrue(np.iscomplexobj(self.pseudo.cqt))
+
+    def test_pitch_binning(self):
+        self.pseudo.front_end = "logstft"
+        y = np.sin(2 * np.pi * 440 * np.arange(self.pseudo.sampling_rate) / self.pseudo.sampling_rate)
+        spectrum = self.pseudo.logstft(y)[:, 20]
+        cqt = np.abs(self.pseudo.compute_cqt(y)[:, 20])
+        self.assertEqual(np.argmax(spectrum), np.argmax(cqt))
+        self.assertAlmostEqual(spectrum.max() / cqt.max(), 1, delta=0.2)
+        self.assertLess(self.pseudo.pitch_binning.nnz, 10 * self.pseudo.n_bins)
+
+    def test_unknown_front_end(self):
+        self.pseudo.front_end = "wavelet"
+        with self.assertRaises(ValueError):
+            self.pseudo.cqt
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            self.pseudo.cross_correlation(engine="falcon")
+
     def test_best_estimate(self):
         pseudo = next(self.pseudo.pseudo_2d)
         cross_corr = self.pseudo.cross_correlate_diag(pseudo, _2D=True)
@@ -36,6 +168,30 @@ class TestPseudo2D(unittest.TestCase):
         self.assertIsInstance(best_estimate, np.ndarray)
 
 
+    def test_peak_picking(self):
+        cross_corr = self.pseudo.cross_correlation(engine="rank1")
+        piano = self.pseudo.peak_picking(cross_corr)
+        expected = np.zeros((self.pseudo.n_notes, cross_corr.shape[1]), dtype=bool)
+        for index, frame in enumerate(cross_corr.T):
+            expected[self.pseudo.best_estimate(frame), index] = True
+        self.assertEqual(piano.dtype, bool)
+        np.testing.assert_array_equal(piano, expected)
+
+    def test_filter_short_notes(self):
+        self.pseudo.min_length = 3
+        piano = np.zeros((self.pseudo.n_notes, 12))
+        piano[0, 0:2] = 1
+        piano[0, 4:9] = 1
+        piano[5, 3:6] = 1
+        piano[7, 10:12] = 1
+        filtered, runs = self.pseudo.filter_short_notes(piano.copy(), return_runs=True)
+        expected = piano.copy()
+        expected[0, 0:2] = 0
+        expected[7, 10:12] = 0
+        np.testing.assert_array_equal(filtered, expected)
+        np.testing.assert_array_equal(runs, [[0, 4, 9], [5, 3, 6]])
+        np.testing.assert_array_equal(self.pseudo.note_runs(filtered), runs)
+
     def test_show_multipitch_estimate(self):
         song, piano = self.pseudo.multipitch_estimate()
         self.assertEqual(len(song), len(piano.T))
@@ -45,3 +201,38 @@ class TestPseudo2D(unittest.TestCase):
         _, piano = self.pseudo.multipitch_estimate()
         song_simple = self.pseudo.to_simple_notation_v2(piano)
         self.assertIsInstance(song_simple, list)
+
+    def test_iter_simple_notation(self):
+        piano = np.zeros((self.pseudo.n_notes, 6))
+        piano[[0, 8], 0:2] = 1
+        piano[8, 3:6] = 1
+        hop = self.pseudo.hop_time
+        expected = [(['E2', 'C3'], 0, 2 * hop), (['C3'], 3 * hop, 2 * hop)]
+        self.assertEqual(self.pseudo.to_simple_notation_v2(piano), expected)
+        self.assertIsInstance(self.pseudo.iter_simple_notation(piano), GeneratorType)
+        self.assertEqual(list(self.pseudo.iter_simple_notation(piano)), expected)
+
+
+class TestStreamingPseudo2D(unittest.TestCase):
+    def setUp(self) -> None:
+        self.path = "song&samples/polyphonic.wav"
+        self.stream = StreamingPseudo2D(self.path, block_duration=5)
+        self.pseudo = Pseudo2D(AudioSignal(self.path))
+
+    def test_cqt_blocks(self):
+        cqt = np.concatenate(list(self.stream.cqt_blocks()), axis=1)
+        self.assertEqual(cqt.shape, self.pseudo.cqt.shape)
+        np.testing.assert_allclose(np.abs(cqt), np.abs(self.pseudo.cqt), atol=1e-3)
+
+    def test_multipitch_estimate(self):
+        _, piano = self.stream.multipitch_estimate(engine="rank1")
+        _, expected_piano = self.pseudo.multipitch_estimate(engine="rank1")
+        np.testing.assert_array_equal(piano, expected_piano)
+
+    def test_filter_short_notes_stream(self):
+        piano_roll = (np.random.default_rng(0).random((self.stream.n_notes, 200)) > 0.5).astype(float)
+        expected = self.stream.filter_short_notes(piano_roll.copy())
+        for block_frames in [1, 3, 50]:
+            blocks = [piano_roll[:, i:i + block_frames] for i in range(0, piano_roll.shape[1], block_frames)]
+            filtered = np.concatenate(list(self.stream.filter_short_notes_stream(blocks)), axis=1)
+            np.testing.assert_array_equal(filtered, expected)
@@ -0,0 +1,62 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from mir.MusicRetrieval import AudioSignal
+from mir.Pseudo2D import Pseudo2D
+from mir.TemplateBank import TemplateBank
+filepath = os.path.abspath(os.path.dirname(__file__))
+SAMPLE_PATH = f'{filepath}/simple_note_progression.wav'
+
+
+class TestTemplateBank(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.bank = TemplateBank(self.directory.name)
+        self.pseudo = Pseudo2D(AudioSignal("song&samples/polyphonic.wav"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_learn_and_load(self):
+        template = self.bank.learn("sine", SAMPLE_PATH, self.pseudo)
+        self.assertEqual(template.shape, self.pseudo.template_matrix.shape)
+        self.assertEqual(self.bank.names, ["sine"])
+        np.testing.assert_allclose(self.bank.load("sine", self.pseudo), template)
+
+    def test_learn_once(self):
+        self.bank.learn("sine", SAMPLE_PATH, self.pseudo)
+        with patch.object(Pseudo2D, "generate_template_from_audio_file") as generate:
+            self.bank.learn("sine", SAMPLE_PATH, self.pseudo)
+            generate.assert_not_called()
+
+    def test_load_with_other_params(self):
+        self.bank.learn("sine", SAMPLE_PATH, self.pseudo)
+        self.pseudo.hop_length = 256
+        with self.assertRaises(KeyError):
+            self.bank.load("sine", self.pseudo)
+
+    def test_unknown_template(self):
+        with self.assertRaises(KeyError):
+            self.bank.load("falcon", self.pseudo)
+
+    def test_invalid_name(self):
+        for name in ("", "..", "../sine", "piano/sine"):
+            with self.assertRaises(ValueError):
+                self.bank.learn(name, SAMPLE_PATH, self.pseudo)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_synthetic(self):
+        np.testing.assert_array_equal(self.bank.load("synthetic", self.pseudo), self.pseudo.template_matrix)
+
+    def test_match_templates(self):
+        self.bank.learn("sine", SAMPLE_PATH, self.pseudo)
+        templates = self.bank.templates(self.pseudo)
+        self.assertEqual(list(templates), ["synthetic", "sine"])
+        matches = self.pseudo.match_templates(templates)
+        for name, template in templates.items():
+            self.pseudo.template_matrix = template
+            np.testing.assert_allclose(matches[name], self.pseudo.cross_correlation(engine="rank1"))
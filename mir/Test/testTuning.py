@@ -0,0 +1,102 @@
+import os
+import sys
+import tempfile
+import unittest
+import csv
+import pretty_midi as pm
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from mir.Tuning import Tuner
+filepath = os.path.abspath(os.path.dirname(__file__))
+AUDIO_PATH = f'{filepath}/simple_note_progression.wav'
+GRID = {"threshold": [0.4, 0.54], "min_length": [1, 4], "gamma": [1, 10]}
+
+
+def read_results(path):
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        return reader.fieldnames, list(reader)
+
+
+class TestTuner(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.midi_path = os.path.join(self.directory.name, "simple_note_progression.midi")
+        midi = pm.PrettyMIDI()
+        piano = pm.Instrument(program=0)
+        for index, pitch in enumerate([60, 64, 67, 72]):
+            piano.notes.append(pm.Note(velocity=100, pitch=pitch, start=0.5 * index, end=0.5 * (index + 1)))
+        midi.instruments.append(piano)
+        midi.write(self.midi_path)
+        self.results_path = os.path.join(self.directory.name, "results.csv")
+        self.pieces = [(AUDIO_PATH, self.midi_path)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_run(self):
+        tuner = Tuner(self.pieces, GRID, self.results_path)
+        results = list(tuner.run())
+        self.assertEqual(len(results), 8)
+        columns, written = read_results(self.results_path)
+        self.assertEqual(columns, tuner.columns)
+        self.assertEqual(len(written), 8)
+        self.assertTrue(all(0 <= result["F-measure"] <= 1 for result in results))
+        best = tuner.best()
+        self.assertAlmostEqual(best["F-measure"], max(float(row["F-measure"]) for row in written))
+        self.assertIn(best["gamma"], GRID["gamma"])
+
+    def test_resume(self):
+        tuner = Tuner(self.pieces, {**GRID, "gamma": [1]}, self.results_path)
+        first = list(tuner.run())
+        tuner = Tuner(self.pieces, GRID, self.results_path)
+        second = list(tuner.run())
+        self.assertEqual(len(first) + len(second), 8)
+        self.assertTrue(all(result["gamma"] == 10 for result in second))
+        self.assertEqual(list(tuner.run()), [])
+        self.assertEqual(len(read_results(self.results_path)[1]), 8)
+
+    def test_parallel(self):
+        expected = sorted(Tuner(self.pieces, GRID, self.results_path).run(), key=str)
+        parallel_path = os.path.join(self.directory.name, "parallel.csv")
+        results = sorted(Tuner(self.pieces, GRID, parallel_path, jobs=2).run(), key=str)
+        self.assertEqual(results, expected)
+
+    def test_split(self):
+        # a sweep of the peak picking only is a single group, shared between the jobs
+        tuner = Tuner(self.pieces, {"threshold": [0.4, 0.54], "min_length": [1, 4]}, self.results_path, jobs=2)
+        tasks = tuner.tasks(AUDIO_PATH, set())
+        self.assertEqual(len(tasks), 1)
+        parts = tuner.split(tasks)
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(sum(parts, []), tasks[0])
+        expected = sorted(Tuner(self.pieces, tuner.grid, os.path.join(self.directory.name, "serial.csv")).run(), key=str)
+        self.assertEqual(sorted(tuner.run(), key=str), expected)
+
+    def test_settings(self):
+        grid = {"threshold": [0.54], "min_length": [1]}
+        self.assertEqual(len(list(Tuner(self.pieces, grid, self.results_path).run())), 1)
+        # the results of another engine or precision are not resumed from
+        self.assertEqual(len(list(Tuner(self.pieces, grid, self.results_path, engine="fft").run())), 1)
+        tuner = Tuner(self.pieces, grid, self.results_path, precision="single")
+        self.assertEqual(len(list(tuner.run())), 1)
+        self.assertEqual(list(tuner.run()), [])
+        _, written = read_results(self.results_path)
+        self.assertEqual([(row["engine"], row["precision"]) for row in written],
+                         [("sparse", "double"), ("fft", "double"), ("sparse", "single")])
+        self.assertEqual(tuner.best()["F-measure"], float(written[2]["F-measure"]))
+
+    def test_old_results(self):
+        # a results file without the settings is not resumed from
+        with open(self.results_path, "w", newline="") as f:
+            csv.writer(f).writerow(["piece", "n_harmonics", "gamma", "std_threshold", "threshold", "min_length",
+                                    "Precision", "Recall", "F-measure"])
+        with self.assertRaises(ValueError):
+            list(Tuner(self.pieces, GRID, self.results_path).run())
+
+    def test_unknown_parameter(self):
+        with self.assertRaises(ValueError):
+            Tuner(self.pieces, {"n_bins_per_octave": [12]}, self.results_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
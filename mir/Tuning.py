@@ -0,0 +1,265 @@
+"""
+Resumable search of the Pseudo2D parameters maximising the F-measure of the transcription (mir tune).
+
+Every configuration of the grid is scored on every piece, a recording with its midi ground truth.
+Each result is appended to the results file as soon as it is known and the configurations already in the results file
+are skipped, so an interrupted search starts again where it stopped. The results are kept per correlation engine and
+precision, a search with other settings does not reuse them.
+"""
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import librosa
+import numpy as np
+import pretty_midi as pm
+from mir_eval.multipitch import evaluate
+from mir_eval.util import f_measure
+from sklearn.model_selection import ParameterGrid
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mir.MusicRetrieval import AudioParams, AudioSignal
+from mir.Pseudo2D import Pseudo2D
+
+# parameters of Pseudo2D that can be tuned, from the most to the least expensive to change:
+# the configurations sharing the first three are evaluated together so only the peak picking and
+# the filtering of the short notes run again between them, see Pseudo2D.staged
+PARAMETERS = ("n_harmonics", "gamma", "std_threshold", "threshold", "min_length")
+GRID = {"n_harmonics": [3, 4], "gamma": [550], "std_threshold": [1e-6], "threshold": [0.54], "min_length": [1]}
+RESULTS_PATH = "Notes/pseudo2d_optimization_results.csv"
+SCORES = ("Precision", "Recall", "F-measure")
+
+
+def ground_truth(midi_path: str, n_frames: int, hop_time: float) -> tuple[np.ndarray, list]:
+    """
+    Frequencies of the notes of the midi file playing at each frame, in the format of mir_eval.multipitch.
+
+    Returns:
+        times: np.ndarray(n_frames,): time of every frame in seconds.
+        frequencies: list of np.ndarray, the frequencies in hz of the notes playing at each frame.
+    """
+    times = np.linspace(0, n_frames * hop_time, n_frames)
+    midi_roll = np.zeros((128, n_frames))
+    for instrument in pm.PrettyMIDI(midi_path).instruments:
+        midi_roll += np.ceil(instrument.get_piano_roll(times=times))
+    return times, [librosa.midi_to_hz(np.flatnonzero(frame)) for frame in midi_roll.T]
+
+
+def evaluate_configuration(pseudo: Pseudo2D, times: np.ndarray, truth: list, config: dict, engine: str) -> dict:
+    """
+    Scores of the transcription by pseudo with the parameters of config.
+    """
+    for name, value in config.items():
+        setattr(pseudo, name, value)
+    song, _ = pseudo.multipitch_estimate(engine=engine)
+    scores = evaluate(times, truth, times, song)
+    return {**config, "Precision": scores["Precision"], "Recall": scores["Recall"],
+            "F-measure": f_measure(scores["Precision"], scores["Recall"])}
+
+
+class Tuner:
+    """
+    Grid search of the Pseudo2D parameters over several pieces.
+    ----------
+    Methods:
+        run() -> return : generator of the results, one dict per piece and configuration
+        best() -> return : configuration with the best mean F-measure over the pieces
+    ----------
+    attributes:
+        columns -> return : columns of the results file
+        settings -> return : engine and precision of the results, written with every result
+    """
+    def __init__(self, pieces: list[tuple[str, str]], grid: dict = GRID, results_path: str = RESULTS_PATH,
+                 engine: str = "sparse", jobs: int = 1, precision: str | None = None):
+        """
+        Parameters:
+            pieces: (audio path, midi path) of every piece.
+            grid: {parameter: list of values}, the parameters missing from the grid keep the default of Pseudo2D.
+            results_path: csv file the results are appended to.
+            engine: correlation engine, see Pseudo2D.cross_correlation.
+            jobs: number of processes evaluating the configurations.
+            precision: floating point precision of the analysis, AudioParams.precision by default.
+
+        Raises:
+            ValueError: if a parameter of the grid can not be tuned, see PARAMETERS.
+        """
+        unknown = set(grid) - set(PARAMETERS)
+        if unknown:
+            raise ValueError(f"Can not tune {sorted(unknown)}, please use some of {PARAMETERS}")
+        self.pieces = pieces
+        self.grid = grid
+        self.results_path = results_path
+        self.engine = engine
+        self.jobs = jobs
+        self.precision = AudioParams.precision if precision is None else precision
+
+    @property
+    def settings(self) -> dict:
+        return {"engine": self.engine, "precision": self.precision}
+
+    @property
+    def columns(self) -> list[str]:
+        return ["piece", *self.settings, *PARAMETERS, *SCORES]
+
+    def configurations(self) -> list[dict]:
+        """
+        Every configuration of the grid, with the default of Pseudo2D for the missing parameters.
+        """
+        defaults = Pseudo2D(None)
+        return [{name: config.get(name, getattr(defaults, name)) for name in PARAMETERS}
+                for config in ParameterGrid(self.grid)]
+
+    def key(self, row: dict) -> tuple:
+        # the piece, the settings and the configuration of a result, compared as written in the results file
+        return tuple(str(row[name]) for name in self.columns[:-len(SCORES)])
+
+    def done(self) -> set:
+        """
+        Keys of the results already in the results file.
+
+        Raises:
+            ValueError: if the results file does not have the columns of the tuner.
+        """
+        if not os.path.exists(self.results_path):
+            return set()
+        with open(self.results_path, newline="") as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames is not None and reader.fieldnames != self.columns:
+                raise ValueError(f"{self.results_path} has the columns {reader.fieldnames} instead of {self.columns}")
+            return {self.key(row) for row in reader}
+
+    def tasks(self, piece: str, done: set) -> list[list[dict]]:
+        """
+        Configurations of piece not evaluated yet, grouped by cross-correlation so a group is evaluated
+        with a single cross-correlation.
+        """
+        groups = {}
+        for config in self.configurations():
+            if self.key({"piece": piece, **self.settings, **config}) not in done:
+                groups.setdefault(tuple(config[name] for name in PARAMETERS[:3]), []).append(config)
+        # min_length changes fastest, the thresholded piano roll is kept between its values
+        return [sorted(configs, key=lambda config: (config["threshold"], config["min_length"]))
+                for configs in groups.values()]
+
+    def run(self):
+        """
+        Evaluate every configuration not in the results file yet, the pieces one after the other.
+
+        Each group of results is written to the results file as soon as it is computed.
+
+        Yields:
+            dict: the piece, the configuration and its scores.
+        """
+        done = self.done()
+        os.makedirs(os.path.dirname(self.results_path) or ".", exist_ok=True)
+        with open(self.results_path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=self.columns)
+            if f.tell() == 0:
+                writer.writeheader()
+            for audio_path, midi_path in self.pieces:
+                tasks = self.tasks(audio_path, done)
+                if not tasks:
+                    continue
+                for results in self.evaluate(audio_path, midi_path, tasks):
+                    rows = [{"piece": audio_path, **self.settings, **result} for result in results]
+                    writer.writerows(rows)
+                    # the results survive a crash of the next configurations
+                    f.flush()
+                    os.fsync(f.fileno())
+                    yield from rows
+
+    def evaluate(self, audio_path: str, midi_path: str, tasks: list[list[dict]]):
+        """
+        Yields the results of every group of configurations of tasks as they are computed.
+
+        The audio is decoded and its cqt computed once, the jobs processes share the cqt through shared memory
+        and receive the ground truth once when they start.
+        The pieces are evaluated one after the other, each with its own pool of processes.
+        """
+        # the signal is loaded in the precision of the tuner, the estimator follows it
+        precision, AudioParams.precision = AudioParams.precision, self.precision
+        try:
+            pseudo = Pseudo2D(AudioSignal(audio_path))
+        finally:
+            AudioParams.precision = precision
+        cqt = pseudo.cqt
+        times, truth = ground_truth(midi_path, cqt.shape[1], pseudo.hop_time)
+        if self.jobs <= 1:
+            for configs in tasks:
+                yield [evaluate_configuration(pseudo, times, truth, config, self.engine) for config in configs]
+            return
+
+        shm = shared_memory.SharedMemory(create=True, size=max(cqt.nbytes, 1))
+        try:
+            shared_cqt = np.ndarray(cqt.shape, dtype=cqt.dtype, buffer=shm.buf)
+            shared_cqt[:] = cqt
+            del shared_cqt
+            with ProcessPoolExecutor(max_workers=self.jobs, initializer=_init_worker,
+                                     initargs=(shm.name, cqt.shape, cqt.dtype, pseudo.precision, times, truth)) as pool:
+                futures = [pool.submit(_evaluate_configurations, configs, self.engine) for configs in self.split(tasks)]
+                for future in as_completed(futures):
+                    yield future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def split(self, tasks: list[list[dict]]) -> list[list[dict]]:
+        """
+        Split the groups of tasks so that there are at least as many groups as jobs, when the groups are large enough.
+        Every part of a group computes the cross-correlation of the group again, in its own process.
+        """
+        n_parts = -(-self.jobs // max(len(tasks), 1))
+        parts = []
+        for configs in tasks:
+            size = -(-len(configs) // n_parts)
+            parts += [configs[start:start + size] for start in range(0, len(configs), size)]
+        return parts
+
+    def best(self) -> dict:
+        """
+        Configuration with the best mean F-measure over the pieces in the results file, with its mean scores.
+        Only the results with the engine and precision of the tuner are compared.
+        """
+        scores = {}
+        with open(self.results_path, newline="") as f:
+            for row in csv.DictReader(f):
+                if any(row[name] != value for name, value in self.settings.items()):
+                    continue
+                scores.setdefault(tuple(row[name] for name in PARAMETERS), []).append(
+                    [float(row[name]) for name in SCORES])
+        means = {config: np.mean(values, axis=0) for config, values in scores.items()}
+        best = max(means, key=lambda config: means[config][SCORES.index("F-measure")])
+        return {**{name: _parse(value) for name, value in zip(PARAMETERS, best)}, **dict(zip(SCORES, means[best]))}
+
+
+def _parse(value: str):
+    """
+    Value of a parameter as written in the results file.
+    """
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+# piece evaluated by a worker process of Tuner.evaluate, set by _init_worker
+_worker = {}
+
+
+def _init_worker(shm_name, shape, dtype, precision, times, truth):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    pseudo = Pseudo2D(None)
+    pseudo.precision = precision
+    pseudo.cqt = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    # the shared memory has to stay open as long as the cqt is used
+    _worker.update(shm=shm, pseudo=pseudo, times=times, truth=truth)
+
+
+def _evaluate_configurations(configs, engine):
+    """
+    Worker of Tuner.evaluate, the estimator keeps the cqt and its stages between the calls.
+    """
+    return [evaluate_configuration(_worker["pseudo"], _worker["times"], _worker["truth"], config, engine)
+            for config in configs]
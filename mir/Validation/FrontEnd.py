@@ -0,0 +1,54 @@
+"""
+Speed and accuracy of the logstft front-end of Pseudo2D with respect to the cqt front-end.
+
+The recording of each midi file is the .wav file of the same name, it is synthesized with fluidsynth if it does not exist.
+
+usage: python mir/Validation/FrontEnd.py [midi files, mir/Validation/polyphonic_piano_test.midi by default]
+"""
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from mir.MusicRetrieval import AudioSignal
+from mir.Pseudo2D import Pseudo2D
+from mir.Tuning import ground_truth, evaluate_configuration
+
+VALIDATION_MIDI = os.path.join(os.path.dirname(__file__), "polyphonic_piano_test.midi")
+# parameters of Validator.benchmark for polyphonic piano
+PARAMETERS = {"gamma": 500, "std_threshold": 1e-6, "min_length": 3, "threshold": 0.54}
+
+
+def transcribe(audio: AudioSignal, midi_path: str, front_end: str, engine: str = "sparse") -> dict:
+    """
+    Time of the spectrum and of the whole transcription of audio with the front-end, and the scores of the transcription.
+    """
+    pseudo = Pseudo2D(audio)
+    pseudo.front_end = front_end
+    start = time.time()
+    pseudo.cqt = pseudo.compute_spectrum(audio.y_harmonic)
+    spectrum_duration = time.time() - start
+    times, truth = ground_truth(midi_path, pseudo.cqt.shape[1], pseudo.hop_time)
+    start = time.time()
+    scores = evaluate_configuration(pseudo, times, truth, PARAMETERS, engine)
+    return {"spectrum time": spectrum_duration, "transcription time": spectrum_duration + time.time() - start,
+            "F-measure": scores["F-measure"]}
+
+
+def compare(midi_path: str) -> dict:
+    """
+    {front-end: measures} of the transcription of the recording of midi_path.
+    """
+    audio_path = os.path.splitext(midi_path)[0] + ".wav"
+    if not os.path.exists(audio_path):
+        from mir.Validation.Validator import convert_midi_to_wav
+        audio_path = convert_midi_to_wav(midi_path)
+    audio = AudioSignal(audio_path)
+    return {front_end: transcribe(audio, midi_path, front_end) for front_end in Pseudo2D.front_ends}
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:] or [VALIDATION_MIDI]:
+        print(path)
+        for front_end, measures in compare(path).items():
+            print(f"    {front_end}: " + ", ".join(f"{name}: {value:.3g}" for name, value in measures.items()))
@@ -0,0 +1,64 @@
+"""
+Speed and accuracy of the yin pitch backend of Mono with respect to the pyin backend.
+
+The accuracy is measured against the pyin transcription: agreement of the voicing, of the rounded pitch
+on the frames both backends find voiced, and of the decoded note states.
+
+usage: python mir/Validation/PitchBackend.py [audio files, song&samples/gamme_C.wav and the test recordings by default]
+"""
+import time
+import sys
+import os
+import numpy as np
+import librosa
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from mir.MusicRetrieval import AudioSignal, Mono
+from mir.Cache import feature_cache
+
+# the pitch is estimated again by every run instead of being loaded from the cache of a previous run
+feature_cache.max_size = 0
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+RECORDINGS = [os.path.join(ROOT, "song&samples", "gamme_C.wav"),
+              os.path.join(ROOT, "mir", "Test", "simple_note_progression.wav"),
+              os.path.join(ROOT, "mir", "Test", "C_scale_dirty.wav")]
+
+
+def transcribe(audio: AudioSignal, pitch_backend: str) -> tuple[Mono, float]:
+    """
+    Mono transcription of audio with the pitch backend and the time taken by the pitch estimation.
+    """
+    start = time.time()
+    mono = Mono(audio, pitch_backend=pitch_backend)
+    duration = time.time() - start
+    return mono, duration
+
+
+def compare(path: str) -> dict:
+    """
+    Measures of the yin backend against the pyin backend on the recording at path.
+    """
+    audio = AudioSignal(path)
+    # the harmonic separation is shared, only the pitch estimation is timed
+    audio.hpss
+    pyin, pyin_duration = transcribe(audio, "pyin")
+    yin, yin_duration = transcribe(audio, "yin")
+    voiced = pyin.voiced_flag & yin.voiced_flag
+    return {
+        "pyin time": pyin_duration,
+        "yin time": yin_duration,
+        "voicing agreement": np.mean(pyin.voiced_flag == yin.voiced_flag),
+        "pitch agreement": np.mean(np.round(librosa.hz_to_midi(pyin.pitch[voiced]))
+                                   == np.round(librosa.hz_to_midi(yin.pitch[voiced]))) if np.any(voiced) else np.nan,
+        "states agreement": np.mean(pyin.encoded_states == yin.encoded_states),
+        "pyin notes": len(pyin.simple_notation(pyin.encoded_state)),
+        "yin notes": len(yin.simple_notation(yin.encoded_state)),
+    }
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:] or RECORDINGS:
+        print(path)
+        for name, value in compare(path).items():
+            print(f"    {name}: {value:.3g}")
@@ -0,0 +1,76 @@
+"""
+Accuracy of the single precision pipeline (AudioParams.precision = 'single') with respect to the double precision one.
+
+usage: python mir/Validation/Precision.py <audio files>
+"""
+import time
+import sys
+import os
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+from mir.MusicRetrieval import AudioParams, AudioSignal, Mono
+from mir.Pseudo2D import Pseudo2D
+from mir.Chord import ChordIdentifier
+from mir.Cache import feature_cache
+
+# the features are computed again by every run instead of being loaded from the cache of a previous run
+feature_cache.max_size = 0
+
+
+# frames of the long recording the monophonic HMM is decoded on, about 40 minutes
+LONG_FRAMES = 100_000
+
+
+def transcribe(path, precision):
+    """
+    Run the polyphonic, monophonic and chord analysis of path with the given precision.
+    """
+    AudioParams.precision = precision
+    try:
+        audio = AudioSignal(path)
+        pseudo = Pseudo2D(audio)
+        pseudo.cqt = pseudo.compute_cqt(audio.y_harmonic)
+        start = time.time()
+        cross_corr = pseudo.cross_correlation(engine="sparse")
+        _, piano_roll = pseudo.multipitch_estimate(engine="sparse")
+        duration = time.time() - start
+        mono = Mono(audio)
+        states = mono.encoded_states
+        chords = ChordIdentifier(audio).solve()
+    finally:
+        AudioParams.precision = "double"
+    # the priors of the recording are repeated up to a long recording, the precision of the path values of the
+    # Viterbi only shows after many frames
+    priors = mono.priors
+    long_states = mono.hmm.viterbi(np.tile(priors, -(-LONG_FRAMES // priors.shape[1]))[:, :LONG_FRAMES])
+    return {"cqt": pseudo.cqt, "cross_corr": cross_corr, "piano_roll": piano_roll, "duration": duration,
+            "states": states, "long_states": long_states, "chords": chords}
+
+
+def compare(path):
+    """
+    Returns the agreement of the single precision transcription of path with the double precision one.
+    """
+    double = transcribe(path, "double")
+    single = transcribe(path, "single")
+    common = np.sum((double["piano_roll"] > 0) & (single["piano_roll"] > 0))
+    f_measure = 2 * common / max(np.sum(double["piano_roll"] > 0) + np.sum(single["piano_roll"] > 0), 1)
+    return {
+        "cqt relative error": np.max(np.abs(single["cqt"] - double["cqt"])) / np.max(np.abs(double["cqt"])),
+        "cross-correlation relative error":
+            np.max(np.abs(single["cross_corr"] - double["cross_corr"])) / np.max(np.abs(double["cross_corr"])),
+        "piano roll F-measure": f_measure,
+        "monophonic states agreement": np.mean(single["states"] == double["states"]),
+        f"monophonic states agreement over {LONG_FRAMES} frames": np.mean(single["long_states"] == double["long_states"]),
+        "chords agreement": np.mean(single["chords"] == double["chords"]),
+        "cqt memory ratio": single["cqt"].nbytes / double["cqt"].nbytes,
+        "polyphonic time ratio": single["duration"] / double["duration"],
+    }
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        print(path)
+        for name, value in compare(path).items():
+            print(f"    {name}: {value:.3g}")
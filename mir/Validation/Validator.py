@@ -12,6 +12,7 @@ import numpy as np
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from MusicRetrieval import  AudioParams, AudioSignal
 from Pseudo2D import Pseudo2D
+from TemplateBank import template_bank
 
 
 params = AudioParams()
@@ -35,7 +36,7 @@ def convert_midi_to_wav(midi_path):
         raise Exception("Error while converting the midi file to wav, is fluidsynth installed ?")
     return name
 
-def benchmark(midi_path, show_piano=None, clean=False,gamma=500,std_threshold=1e-6,min_length=3,threshold=0.54,template_matrix=None):
+def benchmark(midi_path, show_piano=None, clean=False,gamma=500,std_threshold=1e-6,min_length=3,threshold=0.54,template_matrix=None,engine="fft",jobs=1):
     name = convert_midi_to_wav(midi_path)
     audio = AudioSignal(name)
     pseudo = Pseudo2D(audio)
@@ -46,13 +47,14 @@ def benchmark(midi_path, show_piano=None, clean=False,gamma=500,std_threshold=1e
     pseudo.min_length = min_length
     pseudo.threshold = threshold
     if template_matrix is not None:
-        pseudo.template_matrix = pseudo.generate_template_from_audio_file("/Users/antoine/Desktop/GPH/E2024/PFE/mir/single-piano-note-a3_60bpm_A_major.wav")
+        # learned once, the next benchmarks load it from the template bank
+        pseudo.template_matrix = template_bank.learn("piano", "/Users/antoine/Desktop/GPH/E2024/PFE/mir/single-piano-note-a3_60bpm_A_major.wav", pseudo)
     #pseudo.show(1)
     #plt.show()
     #test_result, piano = pseudo.multipitch_estimate()
     # piano = np.roll(piano, -3, axis=1)
 #
-    score = compare(midi_path, pseudo, sampling_rate=audio.sampling_rate, show_piano=show_piano)
+    score = compare(midi_path, pseudo, sampling_rate=audio.sampling_rate, show_piano=show_piano, engine=engine, jobs=jobs)
     f_measure = f(score['Precision'], score["Recall"])
     score['F-measure'] = f_measure
     if clean:
@@ -60,11 +62,31 @@ def benchmark(midi_path, show_piano=None, clean=False,gamma=500,std_threshold=1e
     return score
 
 
-def compare(midi_file_path, pseudo: Pseudo2D ,hop_length = params.hop_length, sampling_rate = params.sampling_rate,show_piano=None):
+def sweep(midi_path, parameter, values, engine="fft", jobs=1, **params):
+    """
+    F-measure of the transcription of midi_path for every value of parameter, ex: sweep(path, "threshold", thresholds).
+
+    The same estimator is used for every value so only the stages of the pipeline depending on parameter
+    are computed again, a sweep over the threshold only runs the peak picking again.
+    params are the other parameters of the estimator, ex: gamma=500.
+    """
+    audio = AudioSignal(convert_midi_to_wav(midi_path))
+    pseudo = Pseudo2D(audio)
+    for name, value in params.items():
+        setattr(pseudo, name, value)
+    scores = []
+    for value in values:
+        setattr(pseudo, parameter, value)
+        score = compare(midi_path, pseudo, sampling_rate=audio.sampling_rate, engine=engine, jobs=jobs)
+        scores.append(f(score['Precision'], score["Recall"]))
+    return scores
+
+
+def compare(midi_file_path, pseudo: Pseudo2D ,hop_length = params.hop_length, sampling_rate = params.sampling_rate,show_piano=None,engine="fft",jobs=1):
     mid = pm.PrettyMIDI(midi_file_path)
 
     # shift the piano roll by 2 frame to match the midi file
-    test_result, piano = pseudo.multipitch_estimate()
+    test_result, piano = pseudo.multipitch_estimate(engine=engine, jobs=jobs)
     #piano = np.roll(piano, -2, axis=1)
     #test_result = test_result[2:] + test_result[:2]
 
@@ -1,4 +1,4 @@
-from mir.MusicRetrieval import AudioSignal, Mono
+from mir.MusicRetrieval import AudioParams, AudioSignal, AudioStream, Mono, StreamingMono
 import numpy as np
 import sys
 import os
@@ -35,10 +35,33 @@ def handle_benchmark(args):
         Factorized Piano Music Modeling and Generation with the MAESTRO Dataset.'
         In International Conference on Learning Representations, 2019.""")
         pgb("-"*l)
-    score = benchmark(args.benchmark, show_piano=args.piano_roll,gamma=args.gamma, threshold=args.threshold, std_threshold=args.standard_deviation)
+    score = benchmark(args.benchmark, show_piano=args.piano_roll,gamma=args.gamma, threshold=args.threshold, std_threshold=args.standard_deviation, engine=args.engine, jobs=args.jobs)
     import pprint
     pprint.pprint(dict(score.items()))
 
+def handle_tune(args):
+    from mir.Tuning import Tuner
+    pieces = []
+    for midi_path in args.pieces:
+        audio_path = os.path.splitext(midi_path)[0] + ".wav"
+        if not os.path.exists(midi_path) or not os.path.exists(audio_path):
+            error(f"File {midi_path} or its recording {audio_path} not found")
+            sys.exit(1)
+        pieces.append((audio_path, midi_path))
+    grid = {"n_harmonics": args.n_harmonics, "gamma": args.gamma, "std_threshold": args.standard_deviation,
+            "threshold": args.threshold, "min_length": args.min_length}
+    tuner = Tuner(pieces, grid, results_path=args.output, engine=args.engine, jobs=args.jobs, precision=args.precision)
+    try:
+        for result in tuner.run():
+            print(", ".join(f"{name}: {value}" for name, value in result.items()
+                            if name not in ("engine", "precision", "Precision", "Recall")))
+    except ValueError as e:
+        error(e)
+        sys.exit(1)
+    pgb(f"Best parameters found (mean over the pieces of {args.output}):")
+    import pprint
+    pprint.pprint(tuner.best())
+
 class CapitalizedHelpFormatter(argparse.HelpFormatter):
     def _format_action_invocation(self, action):
             if not action.option_strings:
@@ -77,6 +100,19 @@ def parse_args(arg_list: list[str] | None = None):
     mono = analysis_parser.add_parser('monophonic', help='Monophonic mode',formatter_class=CapitalizedHelpFormatter )
     poly = analysis_parser.add_parser('polyphonic', help='Polyphonic mode',formatter_class=CapitalizedHelpFormatter )
     chord = analysis_parser.add_parser('chord-only', help='Chord-only mode',formatter_class=CapitalizedHelpFormatter)
+    tune = analysis_parser.add_parser('tune', help='Search the polyphonic parameters against midi ground truths', formatter_class=CapitalizedHelpFormatter)
+    tune.add_argument('pieces', type=str, nargs='+', help='Midi ground truths, the recording of each piece is the .wav file of the same name', metavar='<path/to/midi/file.midi>')
+    tune.add_argument('-t', '--threshold', type=float, nargs='+', help='Thresholds to try', metavar='[0-1]')
+    tune.add_argument('-g', '--gamma', type=int, nargs='+', help='Gamma factors to try', metavar='[1-inf]')
+    tune.add_argument('-std', '--standard-deviation', type=float, nargs='+', help='Standard deviation thresholds to try', metavar='<float>')
+    tune.add_argument('--n-harmonics', type=int, nargs='+', help='Numbers of harmonics of the template to try', metavar='N')
+    tune.add_argument('--min-length', type=int, nargs='+', help='Minimum lengths of a note (in frames) to try', metavar='N')
+    tune.add_argument('--engine', type=str, choices=['fft', 'rank1', 'sparse'], help='Correlation engine')
+    tune.add_argument('-j', '--jobs', type=int, help='Number of processes evaluating the parameters', metavar='N')
+    tune.add_argument('-o', '--output', type=str, help='Results file, the parameters already in it are not evaluated again')
+    tune.add_argument('-p', '--precision', type=str, choices=['double', 'single'], default='double', help='Floating point precision of the analysis, single halves the memory used')
+    tune.set_defaults(threshold=[0.54], gamma=[550], standard_deviation=[1e-6], n_harmonics=[3, 4], min_length=[1],
+                      engine='sparse', jobs=1, output='Notes/pseudo2d_optimization_results.csv')
 
     for p in [mono, poly, chord]:
         piano_debug_group = p.add_mutually_exclusive_group(required=False)
@@ -92,18 +128,33 @@ def parse_args(arg_list: list[str] | None = None):
                 Standard deviation threshold used to determine if a frame is voiced or not,
                 1e-6 work best for polyphonic piano while 1e-3 work best for noisy guitar recording
                 ''', metavar='<float>')
+            p.add_argument('--engine', type=str, choices=['fft', 'rank1', 'sparse'], help='Correlation engine, rank1 and sparse compute the same result as fft directly from the CQT and are much faster, sparse also works with any template')
+            p.add_argument('-j', '--jobs', type=int, help='Number of processes used for the multipitch estimation, only worth it with the fft engine on recordings of several minutes, not with --stream', metavar='N')
+            p.add_argument('--front-end', type=str, choices=['cqt', 'logstft'], help='Spectrum the multipitch estimation is computed from, logstft is faster and lighter than cqt but slightly less accurate')
+            p.add_argument('-s', '--stream', action='store_true', help='Read the file block by block to keep the memory bounded on long recordings, the notes are printed unless -o is given')
+            p.add_argument('--template', type=str, help='Name of the instrument template of the template bank used instead of the synthetic harmonic comb', metavar='<name>')
+            p.add_argument('--template-sample', type=str, help='Single note recording the template is learned from, it is stored in the template bank under the --template name', metavar='<path/to/sample.wav>')
             piano_debug_group.add_argument('-d', '--debug', type=float, help='debug a certain time frame, will show the cross-correlation with the template matrix and pseudo2D spectrum', metavar='<time in seconds>')
-            p.set_defaults(gamma=1, standard_deviation=1e-3, threshold=0.54)
+            p.set_defaults(gamma=1, standard_deviation=1e-3, threshold=0.54, engine='fft', jobs=1, front_end='cqt')
+        if p == mono:
+            p.add_argument('-s', '--stream', action='store_true', help='Transcribe the file block by block and print the notes as soon as they are decided')
+            p.add_argument('--lag', type=float, help='Seconds of audio after a note before it is decided in streaming mode', metavar='<seconds>')
+            p.add_argument('--pitch-backend', type=str, choices=['pyin', 'yin'], help='Pitch estimator, yin is about 50 times faster than pyin but slightly less accurate')
+            p.set_defaults(lag=1.0, pitch_backend='pyin')
 
         input_group.add_argument("-u", '--url', type=str, help='URL to the music file')
         input_group.add_argument('-r', '--recording', action='store_true', help='Record audio from microphone')
         input_group.add_argument('-f', '--file', type=str, help='Path to the music file with .wav extension')
         p.add_argument('-o', '--output', type=str, help='Output file name')
+        p.add_argument('-p', '--precision', type=str, choices=['double', 'single'], default='double', help='Floating point precision of the analysis, single halves the memory used')
 
     if len(sys.argv) == 1:
         parser.print_help(sys.stdout)
         sys.exit(1)
     args = parser.parse_args(arg_list)
+    if args.Modes == "polyphonic" and args.stream and args.jobs > 1:
+        # the blocks of the stream are estimated one after the other
+        parser.error("--jobs can not be used with --stream")
     return args
 
 def handle_extraction(STEM, path_to_audio):
@@ -125,6 +176,11 @@ def main(arg_list: list[str] | None = None):
 
     args = parse_args(arg_list)
 
+    if args.Modes == "tune":
+        AudioParams.precision = args.precision
+        handle_tune(args)
+        sys.exit(0)
+
     if args.file:
         audio_path = str(args.file)
 
@@ -149,8 +205,15 @@ def main(arg_list: list[str] | None = None):
 
     if args.extract:
         audio_path = handle_extraction(args.extract, audio_path)
-    audio = AudioSignal(audio_path)
-    partition = Partition(audio.tempo)
+    AudioParams.precision = args.precision
+    if args.Modes == "polyphonic" and args.stream:
+        # the file is read block by block, it is never loaded as a whole
+        from mir.Pseudo2D import StreamingPseudo2D
+        pseudo2d = StreamingPseudo2D(audio_path)
+    elif args.Modes == "monophonic" and args.stream:
+        stream = AudioStream(audio_path)
+    else:
+        audio = AudioSignal(audio_path)
 
 
 
@@ -159,12 +222,27 @@ def main(arg_list: list[str] | None = None):
 
     if args.Modes == "polyphonic":
         pgb("Polyphonic mode enabled")
-        from mir.Pseudo2D import Pseudo2D
-        pseudo2d = Pseudo2D(audio)
+        if args.stream and args.debug:
+            error("Debugging a time frame is not supported in streaming mode")
+            sys.exit(1)
+        elif not args.stream:
+            from mir.Pseudo2D import Pseudo2D
+            pseudo2d = Pseudo2D(audio)
         pseudo2d.gamma = args.gamma
         pseudo2d.threshold = args.threshold
         pseudo2d.std_threshold = args.standard_deviation
-        _, piano = pseudo2d.multipitch_estimate()
+        pseudo2d.front_end = args.front_end
+        if args.template:
+            from mir.TemplateBank import template_bank
+            try:
+                if args.template_sample:
+                    pseudo2d.template_matrix = template_bank.learn(args.template, args.template_sample, pseudo2d)
+                else:
+                    pseudo2d.template_matrix = template_bank.load(args.template, pseudo2d)
+            except (KeyError, ValueError) as e:
+                error(e)
+                sys.exit(1)
+        _, piano = pseudo2d.multipitch_estimate(engine=args.engine, jobs=args.jobs)
         if args.piano_roll:
             pseudo2d.show_multipitch_estimate(piano)
             sys.exit(0)
@@ -194,10 +272,29 @@ def main(arg_list: list[str] | None = None):
             error("Monophonic mode does not support piano roll visualization")
             sys.exit(1)
         pgb("Monophonic mode enabled")
-        mono = Mono(audio)
-        result = mono.decoded_states
-        simple_notation = mono.simple_notation(result)
-
+        if args.stream:
+            simple_notation = []
+            streaming = StreamingMono(lag=args.lag)
+            streaming.pitch_backend = args.pitch_backend
+            for note in streaming.transcribe(stream.blocks()):
+                print(note)
+                simple_notation.append(note)
+        else:
+            mono = Mono(audio, pitch_backend=args.pitch_backend)
+            # the notes are named from the states, only at their changes
+            simple_notation = mono.simple_notation(mono.encoded_states)
+
+    # the tempo is only estimated when a score is engraved, the streaming modes print the notes unless -o is given
+    engrave = args.output or not args.stream
+    if not engrave:
+        if args.Modes == "polyphonic":
+            for note in simple_notation:
+                print(note)
+    elif args.stream:
+        # estimated on the first minute, the file is never loaded as a whole
+        partition = Partition(pseudo2d.tempo if args.Modes == "polyphonic" else stream.tempo(60 * stream.sampling_rate))
+    else:
+        partition = Partition(audio.tempo)
     if args.output:
         partition.save_score(partition.score(simple_notation, polyphonic=(args.Modes == "polyphonic")), args.output)
 
@@ -221,7 +318,8 @@ def main(arg_list: list[str] | None = None):
             if is_keep.lower() == "n":
                 os.remove(audio_path)
 
-    partition.show(simple_notation,polyphonic=(args.Modes == "polyphonic"))
+    if engrave:
+        partition.show(simple_notation,polyphonic=(args.Modes == "polyphonic"))
 
 
 if __name__ == '__main__':